@@ -0,0 +1,220 @@
+'''Benchmarks the qubes module and dump_vms.py against the stand-in Qubes
+backend in bench/qubes, on any Linux host with Ansible installed.
+
+For every size, a collection of that many qubes is converged from scratch,
+converged again unchanged (both with and without the fingerprint cache),
+updated, converged again through qubes_daemon.py (first while it loads the
+collection, then while it holds it), dumped by dump_vms.py, started, and
+removed again while running.
+Every step runs in a forked process of its own, like a module run by
+Ansible, and reports its wall time, the time per qube, the seconds
+qubes.xml was locked, the peak resident memory of the process and, for
+module runs, the startup time spent importing the module. --json also
+writes the module's own timings.
+'''
+import argparse
+import io
+import json
+import os
+import resource
+import signal
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+
+
+def load_module(name, path):
+    '''Imports a module from its source file'''
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_module(args):
+    '''Runs main() of the qubes module with args, returning its result with
+    the seconds taken to import it as startup'''
+    started = time.time()
+    from ansible.module_utils import basic
+    # Ansible bundles the module_utils the module imports along with it
+    sys.modules['ansible.module_utils.qubes_vms'] = load_module(
+        'ansible.module_utils.qubes_vms', os.path.join(repo_dir, 'module_utils', 'qubes_vms.py'))
+    qubes_module = load_module('ansible_module_qubes', os.path.join(repo_dir, 'modules', 'qubes.py'))
+    startup = time.time() - started
+    qubes_module.host_facts_cache = os.path.join(os.environ['QUBES_BENCH_DIR'], 'host_facts.json')
+    basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=args)).encode('utf-8')
+
+    stdout = sys.stdout
+    sys.stdout = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+    try:
+        qubes_module.main()
+    except SystemExit:
+        pass
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+    return dict(json.loads(output), startup=startup)
+
+
+def run_dump_vms(argv):
+    '''Runs dump_vms.py with argv, discarding its output'''
+    dump_vms = load_module('dump_vms', os.path.join(repo_dir, 'utils', 'dump_vms.py'))
+    sys.argv = ['dump_vms.py'] + argv
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        dump_vms.main()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return {}
+
+
+def start_daemon(socket_path):
+    '''Forks qubes_daemon.py serving on socket_path, returning its pid once
+    it listens'''
+    pid = os.fork()
+    if pid == 0:
+        try:
+            sys.path.insert(0, os.path.join(repo_dir, 'utils'))
+            import qubes_daemon
+            qubes_module = qubes_daemon.load_qubes_module(os.path.join(repo_dir, 'modules', 'qubes.py'),
+                                                          os.path.join(repo_dir, 'module_utils', 'qubes_vms.py'))
+            qubes_module.host_facts_cache = os.path.join(os.environ['QUBES_BENCH_DIR'], 'host_facts.json')
+            qubes_module.import_qubes()
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            qubes_daemon.Daemon(qubes_module).serve(socket_path)
+        finally:
+            os._exit(0)
+
+    deadline = time.time() + 10
+    while not os.path.exists(socket_path):
+        if time.time() >= deadline:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            raise RuntimeError('qubes_daemon.py did not start listening on %s' % socket_path)
+        time.sleep(0.05)
+    return pid
+
+
+def measure(func, *args):
+    '''Calls func in a forked process, returning its result along with the
+    wall time, the seconds qubes.xml was locked and the peak memory'''
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            from qubes import qubes
+            # Only what this step locks, not what the benchmark itself did
+            qubes.statistics['lock_held'] = 0.0
+            started = time.time()
+            result = func(*args)
+            measurement = dict(result=result,
+                               wall=time.time() - started,
+                               lock_held=qubes.statistics['lock_held'],
+                               peak_rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+        except Exception as e:
+            measurement = dict(error='%s: %s' % (type(e).__name__, e))
+        with os.fdopen(write_fd, 'w') as pipe:
+            json.dump(measurement, pipe)
+        os._exit(0)
+
+    os.close(write_fd)
+    with os.fdopen(read_fd) as pipe:
+        measurement = json.load(pipe)
+    os.waitpid(pid, 0)
+    if 'error' in measurement:
+        raise RuntimeError(measurement['error'])
+    return measurement
+
+
+def steps(size, fingerprint_cache, daemon_socket):
+    '''Yields the name, function, arguments and qube count of every step'''
+    common = dict(daemon_socket='', fingerprint_cache='', profile=True)
+    present = [dict(name='bench%d' % index, label='blue', template='fedora-25', netvm='sys-net')
+               for index in range(size)]
+    updated = [dict(qube, memory=800) for qube in present]
+    running = [dict(qube, memory=800, state='running') for qube in present]
+    absent = [dict(name=qube['name'], state='absent') for qube in present]
+
+    yield 'create', run_module, dict(common, qubes=present), size
+    yield 'unchanged', run_module, dict(common, qubes=present), size
+    yield 'record', run_module, dict(common, qubes=present, fingerprint_cache=fingerprint_cache), size
+    yield 'cached', run_module, dict(common, qubes=present, fingerprint_cache=fingerprint_cache), size
+    yield 'update', run_module, dict(common, qubes=updated), size
+    yield 'daemon_load', run_module, dict(common, qubes=updated, daemon_socket=daemon_socket), size
+    yield 'daemon', run_module, dict(common, qubes=updated, daemon_socket=daemon_socket), size
+    yield 'dump_vms', run_dump_vms, ['--minimal'], size + 2
+    yield 'start', run_module, dict(common, qubes=running), size
+    yield 'remove', run_module, dict(common, qubes=absent), size
+
+
+def benchmark(size):
+    '''Runs every step against a new collection, returning their measurements'''
+    from qubes import qubes
+    qubes.create_world()
+    # Enough memory for every qube to start at once, leaving the default
+    # host for small sizes
+    os.environ['QUBES_BENCH_MEMORY'] = str(max(16 * 1024, 4 * 1024 + 1024 * (size + 1)))
+    fingerprint_cache = os.path.join(qubes.base_dir, 'fingerprints.json')
+    daemon_socket = os.path.join(qubes.base_dir, 'daemon.sock')
+    daemon = start_daemon(daemon_socket)
+
+    measurements = []
+    try:
+        for name, func, args, qubes_count in steps(size, fingerprint_cache, daemon_socket):
+            measurement = measure(func, args)
+            if measurement['result'].get('failed'):
+                raise RuntimeError('%s of %d qubes failed: %s' % (name, size, measurement['result'].get('msg')))
+            result = measurement.pop('result')
+            measurement.update(step=name, size=size, per_qube=measurement['wall'] / max(qubes_count, 1),
+                               startup=result.get('startup'), timings=result.get('timings'))
+            measurements.append(measurement)
+    finally:
+        os.kill(daemon, signal.SIGTERM)
+        os.waitpid(daemon, 0)
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the qubes module against a simulated Qubes backend')
+    parser.add_argument('sizes', nargs='*', type=int, default=[10, 100, 1000],
+                        help='Numbers of qubes to benchmark with (default: 10 100 1000)')
+    for operation in ('create', 'start', 'shutdown', 'remove', 'load', 'save'):
+        parser.add_argument('--%s-latency' % operation, type=float, metavar='SECONDS',
+                            help='Seconds each %s takes in the simulated backend' % operation)
+    parser.add_argument('--json', metavar='FILE', help='Also write every measurement to FILE as JSON')
+    args = parser.parse_args()
+
+    os.environ.setdefault('QUBES_BENCH_DIR', tempfile.mkdtemp(prefix='qubes-bench.'))
+    for operation in ('create', 'start', 'shutdown', 'remove', 'load', 'save'):
+        if getattr(args, operation + '_latency') is not None:
+            os.environ['QUBES_BENCH_%s_LATENCY' % operation.upper()] = str(getattr(args, operation + '_latency'))
+    sys.path.insert(0, bench_dir)
+
+    print('%6s %-11s %10s %12s %12s %10s %12s' % ('qubes', 'step', 'wall s', 'per qube ms', 'locked s', 'peak MiB',
+                                                  'startup ms'))
+    measurements = []
+    for size in args.sizes:
+        for measurement in benchmark(size):
+            print('%6d %-11s %10.3f %12.3f %12.3f %10.1f %12s' % (
+                size, measurement['step'], measurement['wall'], measurement['per_qube'] * 1000,
+                measurement['lock_held'], measurement['peak_rss'] / 1024.0 / 1024.0,
+                '-' if measurement['startup'] is None else '%.1f' % (measurement['startup'] * 1000)))
+            sys.stdout.flush()
+            measurements.append(measurement)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(measurements, json_file, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,456 @@
+'''Stand-in for the parts of the Qubes R3.2 dom0 API used by the qubes
+module, dump_vms.py and qubes_daemon.py, for benchmarking them on any Linux
+host. Put the bench directory ahead of everything else on PYTHONPATH.
+
+The collection is kept in qubes.xml under QUBES_BENCH_DIR (a directory in
+/tmp by default), locked the same way as the real one, and qubes get a
+directory with small image files. Running qubes are listed in a file next
+to qubes.xml, so that they persist across processes. Disk creation, start,
+shutdown, removal, load and save are slowed down by the seconds given in
+QUBES_BENCH_<OPERATION>_LATENCY (for example QUBES_BENCH_CREATE_LATENCY),
+or in the latency dict. QUBES_BENCH_MEMORY sets the MB of memory of the
+host. The seconds during which the collection was locked are added up in
+statistics.
+'''
+import ast
+import fcntl
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import xml.etree.ElementTree as ElementTree
+
+base_dir = os.environ.get('QUBES_BENCH_DIR', '/tmp/qubes-bench')
+
+system_path = {
+    'qubes_base_dir': base_dir,
+    'qubes_store_filename': os.path.join(base_dir, 'qubes.xml'),
+    'qubes_kernels_base_dir': os.path.join(base_dir, 'vm-kernels'),
+}
+
+latency = dict((operation, float(os.environ.get('QUBES_BENCH_%s_LATENCY' % operation.upper(), 0)))
+               for operation in ('create', 'start', 'shutdown', 'remove', 'load', 'save'))
+
+statistics = dict(lock_held=0.0, locks=0, loads=0, saves=0)
+
+# Attributes stored in qubes.xml, with the defaults of new qubes
+attrs_config = dict(memory=400,
+                    maxmem=4000,
+                    _mac=None,
+                    pci_strictreset=True,
+                    pci_e820_host=True,
+                    kernel='4.4',
+                    uses_default_kernel=True,
+                    vcpus=2,
+                    kernelopts='nopat',
+                    uses_default_kernelopts=True,
+                    drive=None,
+                    debug=False,
+                    default_user='user',
+                    include_in_backups=True,
+                    qrexec_installed=False,
+                    internal=False,
+                    guiagent_installed=False,
+                    seamless_gui_mode=False,
+                    autostart=False,
+                    qrexec_timeout=60,
+                    timezone='localtime',
+                    uses_default_netvm=True,
+                    uses_default_dispvm_netvm=True,
+                    installed_by_rpm=False,
+                    pool_name='default')
+
+references = ('template', 'netvm', 'dispvm_netvm')
+
+
+class QubesException(Exception):
+    pass
+
+
+class QubesVmLabel(object):
+    def __init__(self, index, name):
+        self.index = index
+        self.name = name
+
+QubesVmLabels = dict((name, QubesVmLabel(index, name)) for index, name in
+                     enumerate(['red', 'orange', 'yellow', 'green', 'gray', 'blue', 'purple', 'black']))
+
+
+class QubesHost(object):
+    '''A host with 8 cpus and QUBES_BENCH_MEMORY MB of memory (16 GiB by
+    default), all but 4 GiB of which are free for qubes until started'''
+    def __init__(self):
+        self.memory_total = int(os.environ.get('QUBES_BENCH_MEMORY', 16 * 1024)) * 1024
+        self.no_cpus = 8
+
+    def get_free_xen_memory(self):
+        return self.memory_total - (4 * 1024 + sum(running().values())) * 1024
+
+
+class QubesVmStorage(object):
+    def __init__(self, vm):
+        self.vm = vm
+
+    def remove_from_disk(self):
+        time.sleep(latency['remove'])
+        shutil.rmtree(self.vm.dir_path)
+
+    def _copy_file(self, source, destination):
+        # Like Qubes, which also preserves holes this way
+        subprocess.check_call(['cp', '--reflink=auto', source, destination])
+
+
+class QubesVm(object):
+    type = 'AppVM'
+    hooks_remove_from_disk = []
+
+    def __init__(self, qid, collection, name, label=None, template=None, netvm=None, dispvm_netvm=None, **kwargs):
+        self.qid = qid
+        self.collection = collection
+        self.name = name
+        self.label = label
+        self.template = template
+        self.netvm = netvm
+        self.dispvm_netvm = dispvm_netvm
+        self.storage = QubesVmStorage(self)
+        self.stopping_at = None
+        for key, default in attrs_config.items():
+            setattr(self, key, default)
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def get_attrs_config(self):
+        return dict((key, dict(default=default)) for key, default in attrs_config.items())
+
+    @property
+    def mac(self):
+        if self._mac is None:
+            return '00:16:3E:5E:6C:%02X' % self.qid
+        return self._mac
+
+    @mac.setter
+    def mac(self, value):
+        self._mac = value
+
+    @property
+    def dir_path(self):
+        return os.path.join(base_dir, 'appvms', self.name)
+
+    @property
+    def root_img(self):
+        return os.path.join(self.dir_path, 'root.img')
+
+    @property
+    def private_img(self):
+        return os.path.join(self.dir_path, 'private.img')
+
+    @property
+    def updateable(self):
+        return self.template is None
+
+    def is_template(self):
+        return False
+
+    def is_netvm(self):
+        return False
+
+    def is_running(self):
+        if self.name in running() and self.stopping_at is not None and time.time() >= self.stopping_at:
+            set_running(self, False)
+        return self.name in running()
+
+    def start(self):
+        if self.is_running():
+            raise QubesException('VM is already running!')
+        time.sleep(latency['start'])
+        self.stopping_at = None
+        set_running(self, True)
+
+    def shutdown(self):
+        self.stopping_at = time.time() + latency['shutdown']
+
+    def force_shutdown(self):
+        set_running(self, False)
+
+    def get_disk_utilization(self):
+        total = 0
+        for root, dirs, files in os.walk(self.dir_path):
+            total += sum(os.lstat(os.path.join(root, name)).st_blocks * 512 for name in files)
+        return total
+
+    def create_on_disk(self, verbose=False, source_template=None):
+        time.sleep(latency['create'])
+        os.makedirs(self.dir_path)
+        if source_template is None:
+            create_image(self.private_img)
+        else:
+            self.storage._copy_file(source_template.private_img, self.private_img)
+            if self.updateable:
+                self.storage._copy_file(source_template.root_img, self.root_img)
+
+    def remove_from_disk(self):
+        for hook in self.hooks_remove_from_disk:
+            hook(self)
+        self.storage.remove_from_disk()
+
+
+class QubesAppVm(QubesVm):
+    pass
+
+
+class QubesNetVm(QubesVm):
+    type = 'NetVM'
+
+    def is_netvm(self):
+        return True
+
+    def shutdown(self):
+        # Like R3.2, netvms refuse to shut down under running clients
+        connected = [vm.name for vm in self.collection.values() if vm.netvm is self and vm.is_running()]
+        if connected:
+            raise QubesException('There are other VMs connected to this VM: %s' % connected)
+        QubesVm.shutdown(self)
+
+
+class QubesProxyVm(QubesNetVm):
+    type = 'ProxyVM'
+
+
+class QubesHVm(QubesVm):
+    type = 'HVM'
+
+
+class QubesTemplateVm(QubesVm):
+    type = 'TemplateVM'
+
+    def is_template(self):
+        return True
+
+    @property
+    def dir_path(self):
+        return os.path.join(base_dir, 'vm-templates', self.name)
+
+
+class QubesTemplateHVm(QubesTemplateVm):
+    type = 'TemplateHVM'
+
+
+class QubesAdminVm(QubesNetVm):
+    type = 'AdminVM'
+
+QubesVmClasses = dict((vm_class.__name__, vm_class) for vm_class in
+                      (QubesAppVm, QubesNetVm, QubesProxyVm, QubesHVm,
+                       QubesTemplateVm, QubesTemplateHVm, QubesAdminVm))
+
+
+def running():
+    '''Memory of the running qubes, by name'''
+    try:
+        with open(os.path.join(base_dir, 'running')) as running_file:
+            return dict((name, int(memory)) for name, memory in
+                        (line.split() for line in running_file if line.strip()))
+    except IOError:
+        return {}
+
+
+def set_running(vm, is_running):
+    with open(os.path.join(base_dir, 'running.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        qubes = running()
+        if is_running:
+            qubes[vm.name] = vm.memory
+        else:
+            qubes.pop(vm.name, None)
+        with open(os.path.join(base_dir, 'running') + '.tmp', 'w') as running_file:
+            running_file.writelines('%s %d\n' % (name, memory) for name, memory in sorted(qubes.items()))
+        os.rename(os.path.join(base_dir, 'running') + '.tmp', os.path.join(base_dir, 'running'))
+
+
+def create_image(path, data=b'', size=2 * 1024 * 1024):
+    '''Writes a sparse disk image of size bytes, starting with data'''
+    with open(path, 'wb') as image:
+        image.write(data)
+        image.truncate(size)
+
+
+def decode(value):
+    return ast.literal_eval(value)
+
+
+def qid(value):
+    return None if value is None else int(value)
+
+
+class QubesVmCollection(dict):
+    '''Qubes by qid, loaded from and saved to qubes.xml'''
+    def __init__(self):
+        dict.__init__(self)
+        self.qubes_store_filename = system_path['qubes_store_filename']
+        self._qubes_store_file = None
+        self.locked_at = None
+        self.default_template_qid = None
+        self.default_netvm_qid = None
+        self.default_kernel = '4.4'
+
+    @property
+    def qubes_store_file(self):
+        return self._qubes_store_file
+
+    @qubes_store_file.setter
+    def qubes_store_file(self, store_file):
+        # Callers may take the lock themselves and hand over the file
+        self.locked_at = time.time()
+        self._qubes_store_file = store_file
+
+    def lock_db(self, mode, operation):
+        while True:
+            store_file = open(self.qubes_store_filename, mode)
+            fcntl.lockf(store_file, operation)
+            # Like R3.2, retry when save() replaced qubes.xml while waiting
+            store = os.fstat(store_file.fileno())
+            current = os.stat(self.qubes_store_filename)
+            if (store.st_dev, store.st_ino) == (current.st_dev, current.st_ino):
+                break
+            store_file.close()
+        self.qubes_store_file = store_file
+
+    def lock_db_for_reading(self):
+        self.lock_db('r', fcntl.LOCK_SH)
+
+    def lock_db_for_writing(self):
+        self.lock_db('r+', fcntl.LOCK_EX)
+
+    def unlock_db(self):
+        statistics['lock_held'] += time.time() - self.locked_at
+        statistics['locks'] += 1
+        self.qubes_store_file.close()
+        self.qubes_store_file = None
+
+    def load(self):
+        time.sleep(latency['load'])
+        statistics['loads'] += 1
+        self.clear()
+        # Like R3.2, only the locked file is read, never qubes.xml by name
+        self.qubes_store_file.seek(0)
+        tree = ElementTree.parse(self.qubes_store_file).getroot()
+        self.default_template_qid = qid(tree.get('default_template'))
+        self.default_netvm_qid = qid(tree.get('default_netvm'))
+        self.default_kernel = tree.get('default_kernel')
+
+        elements = []
+        for element in tree:
+            kwargs = dict((key, decode(value)) for key, value in element.attrib.items()
+                          if key not in ('qid', 'name', 'label') + references)
+            vm = QubesVmClasses[element.tag](int(element.get('qid')), self, element.get('name'),
+                                             QubesVmLabels[element.get('label')], **kwargs)
+            self[vm.qid] = vm
+            elements.append((vm, element))
+        for vm, element in elements:
+            for key in references:
+                setattr(vm, key, self.get(qid(element.get(key))))
+        return True
+
+    def save(self):
+        time.sleep(latency['save'])
+        statistics['saves'] += 1
+        tree = ElementTree.Element('QubesVmCollection')
+        if self.default_template_qid is not None:
+            tree.set('default_template', str(self.default_template_qid))
+        if self.default_netvm_qid is not None:
+            tree.set('default_netvm', str(self.default_netvm_qid))
+        tree.set('default_kernel', self.default_kernel or '')
+        for vm in self.values():
+            element = ElementTree.SubElement(tree, type(vm).__name__)
+            element.set('qid', str(vm.qid))
+            element.set('name', vm.name)
+            element.set('label', vm.label.name)
+            for key in references:
+                if getattr(vm, key) is not None:
+                    element.set(key, str(getattr(vm, key).qid))
+            for key in attrs_config:
+                element.set(key, repr(getattr(vm, key)))
+        # Like R3.2, the new qubes.xml replaces the locked file, which is
+        # then held until unlock_db()
+        new_store_file = tempfile.NamedTemporaryFile(prefix=self.qubes_store_filename, delete=False)
+        ElementTree.ElementTree(tree).write(new_store_file)
+        new_store_file.flush()
+        os.rename(new_store_file.name, self.qubes_store_filename)
+        self.qubes_store_file.close()
+        self._qubes_store_file = new_store_file
+        return True
+
+    def get_vm_by_name(self, name):
+        for vm in self.values():
+            if vm.name == name:
+                return vm
+        return None
+
+    def get_default_template(self):
+        return self.get(self.default_template_qid)
+
+    def get_default_netvm(self):
+        return self.get(self.default_netvm_qid)
+
+    def get_default_kernel(self):
+        return self.default_kernel
+
+    def get_vms_based_on(self, template_qid):
+        return set(vm for vm in self.values() if vm.template is not None and vm.template.qid == template_qid)
+
+    def get_vms_connected_to(self, netvm_qid):
+        # Like R3.2, includes the clients of proxyvms downstream
+        connected = set()
+        netvm_qids = set([netvm_qid])
+        while netvm_qids:
+            clients = set(vm for vm in self.values()
+                          if vm.netvm is not None and vm.netvm.qid in netvm_qids and vm not in connected)
+            connected |= clients
+            netvm_qids = set(vm.qid for vm in clients if vm.is_netvm())
+        return connected
+
+    def get_new_unused_qid(self):
+        new_qid = 1
+        while new_qid in self:
+            new_qid += 1
+        return new_qid
+
+    def add_new_vm(self, vm_type, **kwargs):
+        if self.get_vm_by_name(kwargs['name']) is not None:
+            raise QubesException('VM with this name already exists')
+        vm = QubesVmClasses[vm_type](self.get_new_unused_qid(), self, **kwargs)
+        self[vm.qid] = vm
+        return vm
+
+
+def create_world(appvms=0):
+    '''Replaces everything under QUBES_BENCH_DIR with a collection of dom0,
+    a fedora-25 template, sys-net as the default netvm and appvms named
+    vm0, vm1 and so on'''
+    if os.path.exists(base_dir):
+        shutil.rmtree(base_dir)
+    os.makedirs(os.path.join(system_path['qubes_kernels_base_dir'], '4.4'))
+    with open(system_path['qubes_store_filename'], 'w') as store:
+        store.write('<QubesVmCollection />')
+
+    collection = QubesVmCollection()
+    collection[0] = QubesAdminVm(0, collection, 'dom0', QubesVmLabels['black'])
+    template = collection.add_new_vm('QubesTemplateVm', name='fedora-25', label=QubesVmLabels['black'])
+    netvm = collection.add_new_vm('QubesNetVm', name='sys-net', label=QubesVmLabels['red'],
+                                  template=template, uses_default_netvm=False)
+    collection.default_template_qid = template.qid
+    collection.default_netvm_qid = netvm.qid
+    for index in range(appvms):
+        collection.add_new_vm('QubesAppVm', name='vm%d' % index, label=QubesVmLabels['blue'],
+                              template=template, netvm=netvm)
+
+    os.makedirs(template.dir_path)
+    create_image(template.root_img, os.urandom(256 * 1024), 8 * 1024 * 1024)
+    create_image(template.private_img, os.urandom(16 * 1024))
+    for vm in collection.values():
+        if vm.qid != 0 and not os.path.exists(vm.dir_path):
+            os.makedirs(vm.dir_path)
+    collection.lock_db_for_writing()
+    collection.save()
+    collection.unlock_db()
+    return collection
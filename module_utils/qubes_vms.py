@@ -0,0 +1,99 @@
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017  Nicklaus McClendon <nicklaus@kulinacs.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+'''Describes qubes with the options of the qubes module. Shared by the
+qubes and qubes_facts modules and by dump_vms.py, which loads it from
+source, so it must not depend on Ansible or the Qubes libraries.'''
+import json
+import os
+
+# The properties of a qube set from options of the qubes module, in the
+# order they are applied: the option and the qube attribute it sets
+properties = (
+    ('memory', 'memory'),
+    ('maxmem', 'maxmem'),
+    ('mac', 'mac'),
+    ('pci_strictreset', 'pci_strictreset'),
+    ('pci_e820_host', 'pci_e820_host'),
+    ('netvm', 'netvm'),
+    ('dispvm_netvm', 'dispvm_netvm'),
+    ('kernel', 'kernel'),
+    ('vcpus', 'vcpus'),
+    ('kernelopts', 'kernelopts'),
+    ('drive', 'drive'),
+    ('debug', 'debug'),
+    ('default_user', 'default_user'),
+    ('include_in_backups', 'include_in_backups'),
+    ('qrexec_installed', 'qrexec_installed'),
+    ('internal', 'internal'),
+    ('guiagent_installed', 'guiagent_installed'),
+    ('seamless_gui_mode', 'seamless_gui_mode'),
+    ('autostart', 'autostart'),
+    ('qrexec_timeout', 'qrexec_timeout'),
+    ('timezone', 'timezone'),
+)
+
+
+def store_revision(path):
+    '''Identifies the current contents of a file such as qubes.xml'''
+    store = os.stat(path)
+    return (store.st_ino, store.st_size, store.st_mtime)
+
+
+def write_json(path, value, sort_keys=False):
+    '''Replaces a JSON file, such as a cache, in one rename, creating its
+    directory first if needed'''
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path + '.tmp', 'w') as json_file:
+        json.dump(value, json_file, sort_keys=sort_keys)
+    os.rename(path + '.tmp', path)
+
+
+def qube_values(qube):
+    '''Describes a qube with the options of the qubes module'''
+    current_qube = {}
+    current_qube['name'] = qube.name
+    current_qube['state'] = 'present'
+    current_qube['type'] = qube.type.lower()
+    if qube.template is not None:
+        current_qube['template'] = qube.template.name
+    else:
+        current_qube['template'] = 'none'
+    current_qube['label'] = qube.label.name
+    if qube.netvm is not None:
+        current_qube['netvm'] = qube.netvm.name
+    else:
+        current_qube['netvm'] = 'none'
+    if qube.dispvm_netvm is not None:
+        current_qube['dispvm_netvm'] = qube.dispvm_netvm.name
+    else:
+        current_qube['dispvm_netvm'] = 'none'
+    for param, attribute in properties:
+        if param in current_qube:
+            continue
+        try:
+            current_qube[param] = getattr(qube, attribute)
+        except AttributeError:
+            pass
+    current_qube['pool_name'] = getattr(qube, 'pool_name', 'default')
+    if not qube.is_template() and qube.template is None:
+        current_qube['standalone'] = True
+    else:
+        current_qube['standalone'] = False
+    return current_qube
@@ -27,16 +27,152 @@ short_description: Manage individual qubes (Qubes virtual machines)
 description:
     - Create, destroy, and configure qubes in Qubes
 version_added: "2.3"
-author: "Nicklaus McClendon (@kulinacs)
+author: "Nicklaus McClendon (@kulinacs)"
 options:
   name:
     description:
-      - Target qube
+      - Target qube. Required unless I(qubes) is given
+  qubes:
+    description:
+      - List of qubes to converge in a single run, each entry taking the same
+        options as the module itself (for example the C(qubes_vms) list
+        written by dump_vms.py). The collection is loaded and saved once for
+        the whole list, and per-qube results are returned in C(results).
+        Entries are applied in waves: a qube comes after the templates and
+        netvms it uses, and a removal after the qubes still using it. Waves
+        are converged one after another, and only the disks of the new
+        qubes of a wave are created in parallel, see I(create_concurrency).
+        Before touching anything, the list is checked as a whole, together
+        with the qubes it leaves in place. Qubes listed twice, MAC addresses
+        used twice, references to missing qubes, and autostart qubes whose
+        memory exceeds that of the host or whose maxmem or vcpus exceed
+        I(maxmem_overcommit) and I(vcpu_overcommit), are all reported at
+        once in C(problems). Only problems involving a listed qube, or
+        capacity the list adds to, fail the run. Mutually exclusive with
+        I(name)
+  create_concurrency:
+    description:
+      - Number of new qubes whose disk images are created in parallel. New
+        qubes are registered first, their disks are created on a pool of
+        this many workers, and the collection is saved once afterwards
+    default: 4
+  clone:
+    description:
+      - How the disk images of new qubes are copied from their template.
+        C(reflink) clones them copy-on-write, which needs a filesystem such
+        as btrfs or XFS under the storage pool. C(sparse) copies them
+        leaving out blocks of zeros, and C(full) copies every block. C(auto)
+        reflinks where the filesystem supports it and leaves the copy to
+        Qubes elsewhere. The bytes written for each new qube are returned in
+        C(bytes_written)
+    default: auto
+    choices: ['auto', 'reflink', 'sparse', 'full']
+  shutdown_timeout:
+    description:
+      - Seconds that running qubes to be removed or stopped are given to shut down
+        cleanly, shared by all of them. Qubes are asked to shut down
+        together, before the write lock is taken, and only those still
+        running after the timeout are killed
+    default: 60
+  memory_reserve:
+    description:
+      - MB of free host memory that qubes started together must leave
+        unused. Qubes to be C(running) are started in parallel, netvms and
+        templates before the qubes using them, for as long as the memory
+        of the qubes booting fits in the free memory of the host less this
+        reserve. The others are queued until enough memory is left or
+        nothing else is booting. The seconds each qube took to start are
+        returned as C(boot)
+    default: 0
+  maxmem_overcommit:
+    description:
+      - Number of times the memory of the host that the maxmem of all
+        autostart qubes in a I(qubes) run may add up to, or 0, the default,
+        not to check it
+    default: 0
+  vcpu_overcommit:
+    description:
+      - Number of vcpus per cpu of the host that all autostart qubes may
+        have together, or 0, the default, not to check it
+    default: 0
+  reclaim:
+    description:
+      - How the disk space of removed qubes is reclaimed. C(immediate)
+        deletes their images while holding the write lock. C(deferred)
+        moves their directory into a trash area next to it, and deletes it
+        from a background process once qubes.xml has been saved and
+        unlocked. Directories still waiting to be deleted are returned in
+        C(pending_reclaim)
+    default: immediate
+    choices: ['immediate', 'deferred']
+  reclaim_rate:
+    description:
+      - Upper limit in MB/s at which deferred reclamation frees disk space,
+        or 0 for no limit
+    default: 0
+  reclaim_drain:
+    description:
+      - Bool, whether to finish reclaiming the trash before converging.
+        Check mode leaves the trash alone and only reports C(pending_reclaim)
+    default: False
+  daemon_socket:
+    description:
+      - Unix socket of utils/qubes_daemon.py. When the daemon is listening
+        there, the run is handed over to it, which keeps the collection
+        loaded between runs; otherwise the module converges directly. An
+        empty string always converges directly
+    default: /var/run/qubes/ansible-qubes.sock
+  daemon_timeout:
+    description:
+      - Seconds to wait for utils/qubes_daemon.py to accept the run and
+        then to return its result. The module converges directly when the
+        daemon does not accept the run in time, and fails when the result
+        does not arrive in time, as the daemon may have started converging
+    default: 600
+  fingerprint_cache:
+    description:
+      - File recording the parameters of successful runs with the revision
+        (inode, size and mtime) of qubes.xml they left behind. A run whose
+        parameters match the current revision returns unchanged without
+        loading qubes.xml. Any other change to qubes.xml invalidates it. An
+        empty string disables the cache
+    default: ~/.cache/ansible-qubes/fingerprints.json
+  optimistic:
+    description:
+      - Bool, whether to plan without locking qubes.xml at all, and only
+        take the write lock for a short commit. When qubes.xml changed in
+        the meantime, the plan is rebased onto it, and qubes whose planned
+        attributes were also changed by someone else fail with a conflict
+    default: False
+  lock_timeout:
+    description:
+      - Seconds to wait for the lock on qubes.xml, retrying with
+        exponential backoff, before failing the run. 0 waits forever
+    default: 0
+  profile:
+    description:
+      - Bool, whether to return the C(timings) of the run, whether it
+        succeeds or fails. These are the seconds spent waiting for the read
+        and write locks (C(lock_read), C(lock_write)) and in each phase
+        (C(load), C(plan), C(validate), C(shutdown), C(converge),
+        C(remove_from_disk), C(create_on_disk), C(save), C(start),
+        C(validate_fleet),
+        C(reclaim_drain)),
+        the C(total) wall-clock seconds and the number of C(lookups) made
+        in the collection. C(validate) is part of C(plan) and C(converge),
+        and C(remove_from_disk) part of C(converge)
+    default: False
+  profile_trace:
+    description:
+      - File to which the C(timings) of every profiled run are appended as
+        a line of JSON
   state:
     description:
-      - Desired state of target qube
+      - Desired state of target qube. C(running) and C(stopped) are
+        C(present) qubes which are also started or shut down once their
+        configuration is saved
     default: present
-    choices: ['present', 'absent']
+    choices: ['present', 'absent', 'running', 'stopped']
   type:
     description:
       - Desired type of target qube
@@ -116,25 +252,40 @@ options:
     description:
       - timezone for the target qube
 
+notes:
+  - Supports check mode, returning the planned C(action), attribute
+    C(changes) and C(disk) operations of every qube without writing to
+    qubes.xml, and diff mode, which also shows the attributes of created
+    qubes and the description of removed ones. Runs also return the
+    attribute C(changes) they made
+
 requirements:
   - "python >= 2.6"
   - qubes
 '''
 
 from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.qubes_vms import properties, qube_values, store_revision, write_json
 import re
 import os
-
+import json
+import time
+import hashlib
+import fcntl
+import socket
+import subprocess
+import threading
 try:
-    from qubes.qubes import QubesVmCollection
-    from qubes.qubes import QubesVmLabels
-    from qubes.qubes import QubesVmClasses
-    from qubes.qubes import QubesException
-    from qubes.qubes import QubesHost
-    from qubes.qubes import system_path
-    QUBES_DOM0 = True
+    import queue
 except ImportError:
-    QUBES_DOM0 = False
+    import Queue as queue
+import contextlib
+import random
+import shutil
+
+# The Qubes libraries take long to import, and are only imported by
+# import_qubes() once a run needs them
+QUBES_DOM0 = None
 
 vmtypes = {'appvm': 'QubesAppVm',
            'netvm': 'QubesNetVm',
@@ -142,6 +293,381 @@ vmtypes = {'appvm': 'QubesAppVm',
            'hvm': 'QubesHVm',
            'templatehvm': 'QubesTemplateHVm'}
 
+# Attributes whose getter computes a value when they are unset, such as the
+# auto MAC address, are compared through the attribute storing them when
+# they are to be unset, and through their getter otherwise
+stored_attributes = {'mac': '_mac'}
+
+# ioctl cloning a file on copy-on-write filesystems such as btrfs and XFS
+FICLONE = 0x40049409
+copy_block_size = 64 * 1024
+zero_block = b'\0' * copy_block_size
+
+mac_pattern = re.compile('[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}$|auto$')
+
+host_facts_cache = os.path.expanduser('~/.cache/ansible-qubes/host_facts.json')
+current_host_facts = {}
+
+qube_spec = dict(
+    name=dict(type='str'),
+    state=dict(default='present', choices=['present', 'absent', 'running', 'stopped']),
+    type=dict(default='appvm', choices=['appvm', 'netvm', 'proxyvm', 'hvm', 'templatehvm']),
+    template=dict(type='str'),
+    standalone=dict(default=False, type='bool'),
+    label=dict(choices=['red', 'orange', 'yellow', 'green', 'gray', 'blue', 'purple', 'black']),
+    pool_name=dict(default='default', type='str'),
+    memory=dict(type='int'),
+    maxmem=dict(type='int'),
+    mac=dict(type='str'),
+    pci_strictreset=dict(type='bool'),
+    pci_e820_host=dict(default=False, type='bool'),
+    netvm=dict(type='str'),
+    dispvm_netvm=dict(type='str'),
+    kernel=dict(type='str'),
+    vcpus=dict(type='int'),
+    kernelopts=dict(type='str'),
+    drive=dict(type='str'),
+    debug=dict(type='bool'),
+    default_user=dict(type='str'),
+    include_in_backups=dict(type='bool'),
+    qrexec_installed=dict(type='bool'),
+    internal=dict(type='bool'),
+    guiagent_installed=dict(type='bool'),
+    seamless_gui_mode=dict(type='bool'),
+    autostart=dict(type='bool'),
+    qrexec_timeout=dict(type='int'),
+    timezone=dict(),
+)
+
+argument_spec = dict(qube_spec,
+                     qubes=dict(type='list'),
+                     create_concurrency=dict(default=4, type='int'),
+                     clone=dict(default='auto', choices=['auto', 'reflink', 'sparse', 'full']),
+                     shutdown_timeout=dict(default=60, type='int'),
+                     memory_reserve=dict(default=0, type='int'),
+                     maxmem_overcommit=dict(default=0, type='float'),
+                     vcpu_overcommit=dict(default=0, type='float'),
+                     reclaim=dict(default='immediate', choices=['immediate', 'deferred']),
+                     reclaim_rate=dict(default=0, type='int'),
+                     reclaim_drain=dict(default=False, type='bool'),
+                     daemon_socket=dict(default='/var/run/qubes/ansible-qubes.sock', type='path'),
+                     daemon_timeout=dict(default=600, type='int'),
+                     fingerprint_cache=dict(default='~/.cache/ansible-qubes/fingerprints.json', type='path'),
+                     optimistic=dict(default=False, type='bool'),
+                     lock_timeout=dict(default=0, type='int'),
+                     profile=dict(default=False, type='bool'),
+                     profile_trace=dict(type='path'))
+
+
+def import_qubes():
+    '''Imports the Qubes libraries the first time it is called, returning
+    whether they are available'''
+    global QUBES_DOM0, QubesVmCollection, QubesVmLabels, QubesVmClasses, QubesException, QubesHost, system_path
+    if QUBES_DOM0 is None:
+        try:
+            from qubes.qubes import QubesVmCollection
+            from qubes.qubes import QubesVmLabels
+            from qubes.qubes import QubesVmClasses
+            from qubes.qubes import QubesException
+            from qubes.qubes import QubesHost
+            from qubes.qubes import system_path
+            QUBES_DOM0 = True
+        except ImportError:
+            QUBES_DOM0 = False
+    return QUBES_DOM0
+
+
+class QubeFailure(Exception):
+    '''Raised in place of fail_json when converging an entry of the qubes list'''
+    pass
+
+
+class QubeItem(object):
+    '''Presents one entry of the qubes list to the set_* helpers as a module'''
+    def __init__(self, params):
+        self.params = params
+
+    def fail_json(self, msg, **kwargs):
+        raise QubeFailure(msg)
+
+
+def item_value(key, value, value_type):
+    '''Converts a value of the qubes list to the type given in qube_spec'''
+    if value_type == 'int':
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise QubeFailure('%s must be an integer' % key)
+    elif value_type == 'bool':
+        if isinstance(value, bool):
+            return value
+        if str(value).lower() in ('yes', 'on', 'true', '1'):
+            return True
+        if str(value).lower() in ('no', 'off', 'false', '0'):
+            return False
+        raise QubeFailure('%s must be a boolean' % key)
+    elif value_type == 'str':
+        return '%s' % value
+    return value
+
+
+def item_params(item):
+    '''Verifies an entry of the qubes list and fills in the defaults of qube_spec'''
+    if not isinstance(item, dict):
+        raise QubeFailure('Entries of qubes must be dictionaries')
+    unsupported = sorted(set(item) - set(qube_spec))
+    if unsupported:
+        raise QubeFailure('Unsupported parameters: %s' % ', '.join(unsupported))
+    params = {}
+    for key, spec in qube_spec.items():
+        value = item.get(key)
+        if value is None:
+            value = spec.get('default')
+        if value is not None:
+            value = item_value(key, value, spec.get('type'))
+            if 'choices' in spec and value not in spec['choices']:
+                raise QubeFailure('%s must be one of: %s' % (key, ', '.join(spec['choices'])))
+        params[key] = value
+    if params['name'] is None:
+        raise QubeFailure('Entries of qubes must have a name')
+    return params
+
+
+def boot_id():
+    '''Identifies the current boot of this host'''
+    with open('/proc/sys/kernel/random/boot_id') as boot_id_file:
+        return boot_id_file.read().strip()
+
+
+def host_facts():
+    '''Returns the capacity of this host. QubesHost is queried at most once
+    per run, and the result is cached on disk until the host reboots'''
+    if not current_host_facts:
+        current_boot = boot_id()
+        try:
+            with open(host_facts_cache) as cache:
+                cached = json.load(cache)
+            if cached.get('boot_id') == current_boot:
+                current_host_facts.update(cached)
+        except (IOError, OSError, ValueError):
+            pass
+
+    if not current_host_facts:
+        qubes_host = QubesHost()
+        current_host_facts.update(boot_id=current_boot,
+                                  memory_total=qubes_host.memory_total,
+                                  no_cpus=qubes_host.no_cpus)
+        try:
+            write_json(host_facts_cache, current_host_facts)
+        except (IOError, OSError):
+            pass
+    return current_host_facts
+
+
+class Profiler(object):
+    '''Adds up the wall-clock seconds spent in each phase of a run, and
+    counts the lookups made in the collection'''
+    def __init__(self):
+        self.started = time.time()
+        self.seconds = {}
+        self.lookups = 0
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.seconds[name] = self.seconds.get(name, 0) + time.time() - started
+
+    def timings(self):
+        timings = dict((name, round(seconds, 4)) for name, seconds in self.seconds.items())
+        timings.update(total=round(time.time() - self.started, 4), lookups=self.lookups)
+        return timings
+
+
+def instrument(module, profiler, trace=None):
+    '''Makes the module report the timings of the run when it exits or
+    fails, and append them as a line of JSON to the trace file if given'''
+    def finishing(finish):
+        def finish_profiled(**kwargs):
+            kwargs['timings'] = profiler.timings()
+            if trace:
+                try:
+                    with open(trace, 'a') as trace_file:
+                        trace_file.write(json.dumps(dict(time=profiler.started, pid=os.getpid(),
+                                                         name=module.params['name'],
+                                                         changed=kwargs.get('changed', False),
+                                                         failed=kwargs.get('failed', finish == 'fail_json'),
+                                                         timings=kwargs['timings']), sort_keys=True) + '\n')
+                except (IOError, OSError):
+                    pass
+            return getattr(type(module), finish)(module, **kwargs)
+        return finish_profiled
+
+    module.exit_json = finishing('exit_json')
+    module.fail_json = finishing('fail_json')
+
+
+class QubesVmIndex(object):
+    '''Wraps a QubesVmCollection with lookups by name, qid, template and
+    netvm, built once per load() and kept up to date as qubes are added,
+    changed or popped. It also tracks which revision of qubes.xml it holds,
+    so refresh() only reloads it when it changed on disk or in memory.
+    Locks are given up on after lock_timeout seconds, unless it is 0. Lock
+    waits, loads, saves and lookups are accounted to its profiler.
+    Everything else is passed on to the collection'''
+    indexes = ('qvm_collection', 'revision', 'by_name', 'by_qid', 'dependents', 'clients', 'profiler',
+               'lock_timeout')
+
+    def __init__(self, qvm_collection):
+        self.qvm_collection = qvm_collection
+        self.revision = None
+        self.profiler = Profiler()
+        self.lock_timeout = 0
+        self.reindex()
+
+    def __getattr__(self, name):
+        return getattr(self.qvm_collection, name)
+
+    def __setattr__(self, name, value):
+        if name in self.indexes:
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.qvm_collection, name, value)
+
+    def reindex(self):
+        self.by_name = {}
+        self.by_qid = {}
+        self.dependents = {}
+        self.clients = {}
+        for qube in self.qvm_collection.values():
+            self.index(qube)
+
+    def index(self, qube):
+        self.by_name[qube.name] = qube
+        self.by_qid[qube.qid] = qube
+        if qube.template is not None:
+            self.dependents.setdefault(qube.template.qid, set()).add(qube.qid)
+        if qube.netvm is not None:
+            self.clients.setdefault(qube.netvm.qid, set()).add(qube.qid)
+
+    def unindex(self, qube):
+        self.by_name.pop(qube.name, None)
+        self.by_qid.pop(qube.qid, None)
+        if qube.template is not None:
+            self.dependents.get(qube.template.qid, set()).discard(qube.qid)
+        if qube.netvm is not None:
+            self.clients.get(qube.netvm.qid, set()).discard(qube.qid)
+
+    def lock_db(self, mode, operation):
+        '''Locks qubes.xml like QubesVmCollection does, polling with
+        exponential backoff and raising QubesException after lock_timeout'''
+        deadline = time.time() + self.lock_timeout
+        delay = 0.05
+        while True:
+            store_file = open(self.qubes_store_filename, mode)
+            try:
+                fcntl.lockf(store_file, operation | fcntl.LOCK_NB)
+            except IOError:
+                store_file.close()
+                if time.time() >= deadline:
+                    raise QubesException('Timed out after %s seconds waiting for the lock on qubes.xml'
+                                         % self.lock_timeout)
+                time.sleep(min(random.uniform(delay / 2, delay), max(0, deadline - time.time())))
+                delay = min(delay * 2, 1)
+                continue
+            # save() may have replaced qubes.xml while we were waiting
+            store = os.fstat(store_file.fileno())
+            current = os.stat(self.qubes_store_filename)
+            if (store.st_dev, store.st_ino) == (current.st_dev, current.st_ino):
+                self.qubes_store_file = store_file
+                return
+            store_file.close()
+
+    def lock_db_for_reading(self):
+        with self.profiler.phase('lock_read'):
+            if self.lock_timeout:
+                return self.lock_db('r', fcntl.LOCK_SH)
+            return self.qvm_collection.lock_db_for_reading()
+
+    def lock_db_for_writing(self):
+        with self.profiler.phase('lock_write'):
+            if self.lock_timeout:
+                return self.lock_db('r+', fcntl.LOCK_EX)
+            return self.qvm_collection.lock_db_for_writing()
+
+    def load(self):
+        '''Loads qubes.xml from the locked file or, for optimistic runs
+        holding no lock, from a file opened only for the load, as
+        QubesVmCollection.load() reads from qubes_store_file'''
+        with self.profiler.phase('load'):
+            unlocked = self.qubes_store_file is None
+            if unlocked:
+                self.qubes_store_file = open(self.qubes_store_filename, 'r')
+            try:
+                # The revision of the very file read, which save() may
+                # replace at any time when unlocked
+                store = os.fstat(self.qubes_store_file.fileno())
+                loaded = self.qvm_collection.load()
+            finally:
+                if unlocked:
+                    self.qubes_store_file.close()
+                    self.qubes_store_file = None
+            self.revision = (store.st_ino, store.st_size, store.st_mtime)
+            self.reindex()
+        return loaded
+
+    def refresh(self):
+        '''Loads qubes.xml unless it is already held unmodified'''
+        if self.revision is None or self.revision != store_revision(system_path['qubes_store_filename']):
+            self.load()
+
+    def save(self):
+        with self.profiler.phase('save'):
+            saved = self.qvm_collection.save()
+            self.revision = store_revision(system_path['qubes_store_filename'])
+        return saved
+
+    def get_vm_by_name(self, name):
+        self.profiler.lookups += 1
+        return self.by_name.get(name)
+
+    def get_vm_by_qid(self, qid):
+        self.profiler.lookups += 1
+        return self.by_qid.get(qid)
+
+    def get_vms_based_on(self, template_qid):
+        self.profiler.lookups += 1
+        return set(self.by_qid[qid] for qid in self.dependents.get(template_qid, ()))
+
+    def get_direct_clients(self, netvm_qid):
+        '''Unlike get_vms_connected_to, leaves out the clients of proxyvms
+        connected to the netvm'''
+        self.profiler.lookups += 1
+        return set(self.by_qid[qid] for qid in self.clients.get(netvm_qid, ()))
+
+    def add_new_vm(self, vm_type, **kwargs):
+        self.revision = None
+        qube = self.qvm_collection.add_new_vm(vm_type, **kwargs)
+        self.index(qube)
+        return qube
+
+    def pop(self, qid, *default):
+        self.revision = None
+        if qid in self.by_qid:
+            self.unindex(self.by_qid[qid])
+        return self.qvm_collection.pop(qid, *default)
+
+    def set_attribute(self, qube, key, value):
+        '''Sets an attribute of the qube, keeping the indexes current'''
+        self.revision = None
+        self.unindex(qube)
+        setattr(qube, key, value)
+        self.index(qube)
+
 
 def set_label(module, options):
     '''Verifies and sets the label'''
@@ -177,138 +703,133 @@ def set_standalone(options):
         options['standalone'] = True
 
 
-def set_memory(module, options):
-    '''Sets starting memory if passed, and verifies the value'''
-    if module.params['memory'] is not None:
-        if module.params['memory'] <= 0:
-            module.fail_json(msg='Memory cannot be negative')
-        qubes_host = QubesHost()
-        if module.params['memory'] > qubes_host.memory_total/1024:
-            module.fail_json(msg='This host has only %s MB of RAM' % str(qubes_host.memory_total/1024))
-        options['args']['memory'] = module.params['memory']
+def set_memory(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets a memory size in MB'''
+    if value <= 0:
+        module.fail_json(msg='Memory cannot be negative')
+    memory_total = host_facts()['memory_total'] // 1024
+    if value > memory_total:
+        module.fail_json(msg='This host has only %s MB of RAM' % str(memory_total))
+    options['args'][attribute] = value
 
 
-def set_maxmem(module, options):
-    '''Sets max memory if passed, and verifies the value'''
-    if module.params['maxmem'] is not None:
-        if module.params['maxmem'] <= 0:
-            module.fail_json(msg='Memory cannot be negative')
-        qubes_host = QubesHost()
-        if module.params['maxmem'] > qubes_host.memory_total/1024:
-            module.fail_json(msg='This host has only %s MB of RAM' % str(qubes_host.memory_total/1024))
-        options['args']['maxmem'] = module.params['maxmem']
-
-
-def set_mac(module, options):
-    '''Sets mac address if passed, and verifies the value'''
-    if module.params['mac'] is not None:
-        if not re.match('[0-9a-fA-F]{2}(:[0-9a-fA-F]{2}){5}$|auto$', module.params['mac']):
-            module.fail_json(msg='The MAC address must be auto or of the form XX:XX:XX:XX:XX:XX')
-        if module.params['mac'] == 'auto':
-            options['args']['mac'] = None
-        else:
-            options['args']['mac'] = module.params['mac']
-
-
-def set_netvm(module, qvm_collection, options):
-    '''Sets netvm if passed, and verifies the value'''
-    if module.params['netvm'] is not None:
-        if module.params['netvm'] == 'none':
-            options['args']['netvm'] = None
-            options['args']['uses_default_netvm'] = False
-        elif module.params['netvm'] == 'default':
-            options['args']['netvm'] = qvm_collection.get_default_netvm()
-            options['args']['uses_default_netvm'] = True
-        else:
-            options['args']['netvm'] = qvm_collection.get_vm_by_name(module.params['netvm'])
-            if options['args']['netvm'] is None:
-                module.fail_json(msg='netvm: %s does not exist' % module.params['netvm'])
-            if not options['args']['netvm'].is_netvm():
-                module.fail_json(msg='%s is not a netvm' % module.params['netvm'])
-            options['args']['uses_default_netvm'] = False
-
-
-def set_dispvm_netvm(module, qvm_collection, options):
-    '''Sets dispvm_netvm if passed, and verifies the value'''
-    if module.params['dispvm_netvm'] is not None:
-        if module.params['dispvm_netvm'] == 'none':
-            options['args']['dispvm_netvm'] = None
-            options['args']['uses_default_dispvm_netvm'] = False
-        elif module.params['dispvm_netvm'] == 'default':
-            options['args']['uses_default_dispvm_netvm'] = True
-        else:
-            options['args']['dispvm_netvm'] = qvm_collection.get_vm_by_name(module.params['dispvm_netvm'])
-            if options['args']['dispvm_netvm'] is None:
-                module.fail_json(msg='dispvm_netvm: %s does not exist' % module.params['dispvm_netvm'])
-            if not options['args']['dispvm_netvm'].is_netvm():
-                module.fail_json(msg='%s is not a dispvm_netvm' % module.params['dispvm_netvm'])
-            options['args']['uses_default_dispvm_netvm'] = False
-
-
-def set_kernel(module, qvm_collection, options):
-    '''Sets kernel if passed, and verifies the value'''
-    if module.params['kernel'] is not None:
-        if module.params['kernel'] == 'none':
-            options['args']['kernel'] = None
-            options['args']['uses_default_kernel'] = False
-        elif module.params['kernel'] == 'default':
-            options['args']['kernel'] = qvm_collection.get_default_kernel()
-            options['args']['uses_default_kernel'] = True
-        else:
-            if not os.path.exists(os.path.join(system_path["qubes_kernels_base_dir"], module.params['kernel'])):
-                module.fail_json(msg='kernel: %s does not exist' % module.params['kernel'])
-            options['args']['kernel'] = module.params['kernel']
-            options['args']['uses_default_kernel'] = False
+def set_mac(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the mac address'''
+    if not mac_pattern.match(value):
+        module.fail_json(msg='The MAC address must be auto or of the form XX:XX:XX:XX:XX:XX')
+    if value == 'auto':
+        options['args'][attribute] = None
+    else:
+        options['args'][attribute] = value
 
 
-def set_vcpus(module, options):
-    '''Sets starting vcpus if passed, and verifies the value'''
-    if module.params['vcpus'] is not None:
-        if module.params['vcpus'] <= 0:
-            module.fail_json(msg='Vcpus cannot be negative')
-        qubes_host = QubesHost()
-        if module.params['vcpus'] > qubes_host.no_cpus:
-            module.fail_json(msg='This host has only %s cpus' % str(qubes_host.no_cpus))
-        options['args']['vcpus'] = module.params['vcpus']
+def set_netvm(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the netvm'''
+    if value == 'none':
+        options['args'][attribute] = None
+        options['args']['uses_default_netvm'] = False
+    elif value == 'default':
+        options['args'][attribute] = qvm_collection.get_default_netvm()
+        options['args']['uses_default_netvm'] = True
+    else:
+        options['args'][attribute] = qvm_collection.get_vm_by_name(value)
+        if options['args'][attribute] is None:
+            module.fail_json(msg='netvm: %s does not exist' % value)
+        if not options['args'][attribute].is_netvm():
+            module.fail_json(msg='%s is not a netvm' % value)
+        options['args']['uses_default_netvm'] = False
 
 
-def set_kernelopts(module, options):
-    '''Sets kernelopts if passed, and verifies the value'''
-    if module.params['kernelopts'] is not None:
-        if module.params['kernelopts'] == 'default':
-            options['args']['uses_default_kernelopts'] = True
-        else:
-            options['args']['kernelopts'] = module.params['kernelopts']
-            options['args']['uses_default_kernelopts'] = False
+def set_dispvm_netvm(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the netvm of disposable vms'''
+    if value == 'none':
+        options['args'][attribute] = None
+        options['args']['uses_default_dispvm_netvm'] = False
+    elif value == 'default':
+        options['args']['uses_default_dispvm_netvm'] = True
+    else:
+        options['args'][attribute] = qvm_collection.get_vm_by_name(value)
+        if options['args'][attribute] is None:
+            module.fail_json(msg='dispvm_netvm: %s does not exist' % value)
+        if not options['args'][attribute].is_netvm():
+            module.fail_json(msg='%s is not a dispvm_netvm' % value)
+        options['args']['uses_default_dispvm_netvm'] = False
 
 
-def set_drive(module, options):
-    '''Sets drive if passed, and verifies the value'''
-    if module.params['drive'] is not None:
-        if module.params['drive'] == 'none':
-            options['args']['drive'] = None
-        else:
-            options['args']['drive'] = module.params['drive']
+def set_kernel(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the kernel'''
+    if value == 'none':
+        options['args'][attribute] = None
+        options['args']['uses_default_kernel'] = False
+    elif value == 'default':
+        options['args'][attribute] = qvm_collection.get_default_kernel()
+        options['args']['uses_default_kernel'] = True
+    else:
+        if not os.path.exists(os.path.join(system_path["qubes_kernels_base_dir"], value)):
+            module.fail_json(msg='kernel: %s does not exist' % value)
+        options['args'][attribute] = value
+        options['args']['uses_default_kernel'] = False
 
 
-def set_qrexec_timeout(module, options):
-    '''Sets qrexec_timeout if passed, and verifies the value'''
-    if module.params['qrexec_timeout'] is not None:
-        if module.params['qrexec_timeout'] < 0:
-            module.fail_json(msg='qrexec_timeout cannot be negative')
-        options['args']['qrexec_timeout'] = module.params['qrexec_timeout']
+def set_vcpus(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the number of vcpus'''
+    if value <= 0:
+        module.fail_json(msg='Vcpus cannot be negative')
+    no_cpus = host_facts()['no_cpus']
+    if value > no_cpus:
+        module.fail_json(msg='This host has only %s cpus' % str(no_cpus))
+    options['args'][attribute] = value
 
 
-def set_timezone(module, options):
-    '''Sets timezone  if passed, and verifies the value'''
-    if module.params['timezone'] is not None:
-        if module.params['timezone'] == 'localtime':
-            options['args']['timezone'] = module.params['timezone']
-        else:
-            try:
-                options['args']['timezone'] = int(module.params['timezone'])
-            except:
-                module.fail_json(msg='timezone must be localtime or an integer offset')
+def set_kernelopts(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the kernelopts'''
+    if value == 'default':
+        options['args']['uses_default_kernelopts'] = True
+    else:
+        options['args'][attribute] = value
+        options['args']['uses_default_kernelopts'] = False
+
+
+def set_drive(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the drive'''
+    if value == 'none':
+        options['args'][attribute] = None
+    else:
+        options['args'][attribute] = value
+
+
+def set_qrexec_timeout(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the qrexec_timeout'''
+    if value < 0:
+        module.fail_json(msg='qrexec_timeout cannot be negative')
+    options['args'][attribute] = value
+
+
+def set_timezone(module, qvm_collection, options, attribute, value):
+    '''Verifies and sets the timezone'''
+    if value == 'localtime':
+        options['args'][attribute] = value
+    else:
+        try:
+            options['args'][attribute] = int(value)
+        except:
+            module.fail_json(msg='timezone must be localtime or an integer offset')
+
+
+# The functions verifying and setting the properties listed in
+# module_utils/qubes_vms.py, by parameter. Properties without one are set to
+# the value as given
+validators = {'memory': set_memory,
+              'maxmem': set_memory,
+              'mac': set_mac,
+              'netvm': set_netvm,
+              'dispvm_netvm': set_dispvm_netvm,
+              'kernel': set_kernel,
+              'vcpus': set_vcpus,
+              'kernelopts': set_kernelopts,
+              'drive': set_drive,
+              'qrexec_timeout': set_qrexec_timeout,
+              'timezone': set_timezone}
 
 
 def set_options(module, qvm_collection):
@@ -325,141 +846,1015 @@ def set_options(module, qvm_collection):
     options['base_template'] = options['args']['template']
     if options['standalone']:
         options['args']['template'] = None
-    set_memory(module, options)
-    set_maxmem(module, options)
-    set_mac(module, options)
-    if module.params['pci_strictreset'] is not None:
-        options['args']['pci_strictreset'] = module.params['pci_strictreset']
-    if module.params['pci_e820_host'] is not None:
-        options['args']['pci_e820_host'] = module.params['pci_e820_host']
-    set_netvm(module, qvm_collection, options)
-    set_dispvm_netvm(module, qvm_collection, options)
-    set_kernel(module, qvm_collection, options)
-    set_vcpus(module, options)
-    set_kernelopts(module, options)
-    set_drive(module, options)
-    if module.params['debug'] is not None:
-        options['args']['debug'] = module.params['debug']
-    if module.params['default_user'] is not None:
-        options['args']['default_user'] = module.params['default_user']
-    if module.params['include_in_backups'] is not None:
-        options['args']['include_in_backups'] = module.params['include_in_backups']
-    if module.params['qrexec_installed'] is not None:
-        options['args']['qrexec_installed'] = module.params['qrexec_installed']
-    if module.params['internal'] is not None:
-        options['args']['internal'] = module.params['internal']
-    if module.params['guiagent_installed'] is not None:
-        options['args']['guiagent_installed'] = module.params['guiagent_installed']
-    if module.params['seamless_gui_mode'] is not None:
-        options['args']['seamless_gui_mode'] = module.params['seamless_gui_mode']
-    if module.params['autostart'] is not None:
-        options['args']['autostart'] = module.params['autostart']
-    set_qrexec_timeout(module, options)
-    set_timezone(module, options)
+    for param, attribute in properties:
+        value = module.params[param]
+        if value is None:
+            continue
+        validator = validators.get(param)
+        if validator is None:
+            options['args'][attribute] = value
+        else:
+            validator(module, qvm_collection, options, attribute, value)
     return options
 
 
-def main():
-    module = AnsibleModule(
-        argument_spec=dict(
-            name=dict(required=True, type='str'),
-            state=dict(default='present', choices=['present', 'absent']),
-            type=dict(default='appvm', choices=['appvm', 'netvm', 'proxyvm', 'hvm', 'templatehvm']),
-            template=dict(type='str'),
-            standalone=dict(default=False, type='bool'),
-            label=dict(choices=['red', 'orange', 'yellow', 'green', 'gray', 'blue', 'purple', 'black']),
-            pool_name=dict(default='default', type='str'),
-            memory=dict(type='int'),
-            maxmem=dict(type='int'),
-            mac=dict(type='str'),
-            pci_strictreset=dict(type='bool'),
-            pci_e820_host=dict(default=False, type='bool'),
-            netvm=dict(type='str'),
-            dispvm_netvm=dict(type='str'),
-            kernel=dict(type='str'),
-            vcpus=dict(type='int'),
-            kernelopts=dict(type='str'),
-            drive=dict(type='str'),
-            debug=dict(type='bool'),
-            default_user=dict(type='str'),
-            include_in_backups=dict(type='bool'),
-            qrexec_installed=dict(type='bool'),
-            internal=dict(type='bool'),
-            guiagent_installed=dict(type='bool'),
-            seamless_gui_mode=dict(type='bool'),
-            autostart=dict(type='bool'),
-            qrexec_timeout=dict(type='int'),
-            timezone=dict(),
-        )
-    )
+def run_parallel(func, items, concurrency):
+    '''Calls func on every item from at most concurrency threads, returning
+    a (result, exception) pair for each item in order'''
+    results = [(None, None)] * len(items)
+    pending = list(enumerate(items))
+    pending_lock = threading.Lock()
 
-    if not QUBES_DOM0:
-        module.fail_json(msg='This module must be run from QubeOS dom0')
+    def worker():
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                index, item = pending.pop(0)
+            try:
+                results[index] = (func(item), None)
+            except Exception as e:
+                results[index] = (None, e)
+
+    workers = [threading.Thread(target=worker) for _ in range(max(1, min(concurrency, len(items))))]
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return results
 
-    qvm_collection = QubesVmCollection()
-    qvm_collection.lock_db_for_writing()
-    qvm_collection.load()
 
-    # Set parameters
-    changed = True
-    options = set_options(module, qvm_collection)
+def reflink(source, destination):
+    '''Clones a file with the FICLONE ioctl, sharing its blocks copy-on-write'''
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            try:
+                fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+            except (IOError, OSError):
+                os.unlink(destination)
+                raise
 
-    if options['state'] == 'present':
-        if qvm_collection.get_vm_by_name(options['args']['name']) is not None:
-            changed = False
-            qube = qvm_collection.get_vm_by_name(options['args']['name'])
 
-            for key in options['args']:
-                if key == 'pool_name':
-                    if qube.pool_name != options['args']['pool_name']:
-                        module.fail_json(msg='Existing VM storage pool cannot be changed')
-                elif getattr(qube, key) != options['args'][key]:
-                    setattr(qube, key, options['args'][key])
-                    changed = True
+def copy_file(source, destination, sparse=True):
+    '''Copies a file block by block, returning the bytes written. When
+    sparse, blocks of zeros are skipped and left as holes'''
+    written = 0
+    with open(source, 'rb') as source_file:
+        with open(destination, 'wb') as destination_file:
+            while True:
+                block = source_file.read(copy_block_size)
+                if not block:
+                    break
+                if sparse and block == zero_block[:len(block)]:
+                    destination_file.seek(len(block), os.SEEK_CUR)
+                else:
+                    destination_file.write(block)
+                    written += len(block)
+            destination_file.truncate()
+    shutil.copymode(source, destination)
+    return written
 
-            if not isinstance(qube, QubesVmClasses[options['type']]):
-                module.fail_json(msg='Existing VM type cannot be changed')
 
-        else:
+def clone_file(source, destination, strategy, copy):
+    '''Copies a disk image with the clone strategy, returning the bytes
+    written. auto reflinks where the filesystem supports it, and otherwise
+    leaves the copy to copy, the storage's own cp --reflink=auto, which
+    skips holes natively and writes the bytes it allocates'''
+    if strategy in ('auto', 'reflink'):
+        try:
+            reflink(source, destination)
+            return 0
+        except (IOError, OSError):
+            if strategy == 'reflink':
+                raise
+    if strategy == 'auto':
+        copy(source, destination)
+        return allocated(destination)
+    return copy_file(source, destination, sparse=strategy == 'sparse')
+
+
+def provision(qvm_collection, created, concurrency, clone='auto', written=None):
+    '''Creates the disks of newly registered qubes in parallel, copying
+    images with the clone strategy and adding up the bytes written for each
+    qube in written, or None when the storage cannot be told how to copy
+    them. Qubes whose disk creation fails are removed from the
+    collection again, and a (qube, exception) pair is returned for each'''
+    preexisting = set(qube.qid for qube, base_template in created if os.path.exists(qube.dir_path))
+    if written is None:
+        written = {}
+
+    def create_on_disk(creation):
+        qube, base_template = creation
+        written[qube.name] = None
+        # Images are copied from the template through the storage
+        if hasattr(qube.storage, '_copy_file'):
+            copy = qube.storage._copy_file
+            written[qube.name] = 0
+
+            def clone_image(source, destination):
+                written[qube.name] += clone_file(source, destination, clone, copy)
+            qube.storage._copy_file = clone_image
+        elif clone != 'auto':
+            raise QubesException('The storage of this qube cannot clone images with %s' % clone)
+        qube.create_on_disk(source_template=base_template)
+
+    failures = []
+    for (qube, base_template), (result, error) in zip(created, run_parallel(create_on_disk, created, concurrency)):
+        if error is None:
+            continue
+        if qube.qid not in preexisting:
             try:
-                qube = qvm_collection.add_new_vm(options['type'], **options['args'])
-            except QubesException as e:
-                module.fail_json(msg='Unable to create VM: %s' % e)
+                qube.remove_from_disk()
+            except (IOError, OSError, QubesException):
+                pass
+        qvm_collection.pop(qube.qid)
+        failures.append((qube, error))
+    return failures
+
 
-            qube.create_on_disk(source_template=options['base_template'])
+def diff_qube(module, qube, options):
+    '''Verifies an existing qube against options, returning the attributes
+    that differ as {key: (current, desired)}'''
+    if qube.pool_name != options['args']['pool_name']:
+        module.fail_json(msg='Existing VM storage pool cannot be changed')
+    if not isinstance(qube, QubesVmClasses[options['type']]):
+        module.fail_json(msg='Existing VM type cannot be changed')
+
+    changes = {}
+    for key in options['args']:
+        if options['args'][key] is None:
+            current = getattr(qube, stored_attributes.get(key, key))
+        else:
+            current = getattr(qube, key)
+        if key != 'pool_name' and current != options['args'][key]:
+            changes[key] = (current, options['args'][key])
+    return changes
+
+
+def check_removal(module, qvm_collection, qube):
+    '''Verifies that the qube may be removed'''
+    if qube.is_template(): # Report what VMs use this template
+        dependent_qubes = qvm_collection.get_vms_based_on(qube.qid)
+        if len(dependent_qubes) > 0:
+            module.fail_json(msg='Please remove VMs dependent on this template first')
+
+    if qube.installed_by_rpm:
+        module.fail_json(msg='Qube managed by RPM/DNF')
+
+
+def plan(module, qvm_collection):
+    '''Works out what converge() would do to the qube described by
+    module.params, without modifying the collection'''
+    with qvm_collection.profiler.phase('validate'):
+        options = set_options(module, qvm_collection)
+    step = dict(action=None, options=options, changes={})
+    qube = qvm_collection.get_vm_by_name(options['args']['name'])
+
+    if options['state'] != 'absent':
+        if qube is None:
+            step['action'] = 'create'
+        else:
+            step['changes'] = diff_qube(module, qube, options)
+            if step['changes']:
+                step['action'] = 'update'
 
     elif options['state'] == 'absent':
-        if qvm_collection.get_vm_by_name(options['args']['name']) is None:
-            changed = False
+        if qube is not None:
+            check_removal(module, qvm_collection, qube)
+            step['action'] = 'remove'
+            step['removed'] = qube_values(qube)
+
+    return step
+
+
+def describe(value):
+    '''Renders an attribute value for the module result, naming labels and qubes'''
+    if hasattr(value, 'name'):
+        return value.name
+    return value
+
+
+def describe_changes(step):
+    '''Renders the attribute changes of a step as before/after pairs'''
+    return dict((key, dict(before=describe(before), after=describe(after)))
+                for key, (before, after) in step['changes'].items())
+
+
+def step_diff(step):
+    '''Renders a step as the before and after states of diff mode: the
+    attributes a new qube is created with, the description of a removed
+    qube, and the changed attributes of an updated one'''
+    if step['action'] == 'create':
+        return {}, dict((key, describe(value)) for key, value in step['options']['args'].items()
+                        if value is not None)
+    if step['action'] == 'remove':
+        return step['removed'], {}
+    changes = describe_changes(step)
+    return (dict((key, change['before']) for key, change in changes.items()),
+            dict((key, change['after']) for key, change in changes.items()))
+
+
+def allocated(path):
+    '''Bytes of disk actually used by a file, or None if it is missing'''
+    try:
+        return os.stat(path).st_blocks * 512
+    except OSError:
+        return None
+
+
+def disk_operations(qvm_collection, step):
+    '''Lists the disk operations a planned step would perform, with the
+    bytes each is expected to write or free'''
+    options = step['options']
+    operations = []
+    if step['action'] == 'create':
+        source = options['base_template']
+        if source is None:
+            operations.append(dict(operation='create', image='private.img', bytes=None))
         else:
-            qube = qvm_collection.get_vm_by_name(options['args']['name'])
+            if options['args'].get('template') is None:
+                operations.append(dict(operation='copy', image='root.img', source=source.name,
+                                       bytes=allocated(source.root_img)))
+            operations.append(dict(operation='copy', image='private.img', source=source.name,
+                                   bytes=allocated(source.private_img)))
+    elif step['action'] == 'remove':
+        qube = qvm_collection.get_vm_by_name(options['args']['name'])
+        operations.append(dict(operation='remove', image=qube.dir_path,
+                               bytes=qube.get_disk_utilization()))
+    return operations
 
-            if qube.is_running():
-                try:
-                    qube.force_shutdown()
-                except (IOError, OSError, QubesException) as e:
-                    module.fail_json(msg='Unable to shutdown VM: %s' % e)
 
-            if qube.is_template(): # Report what VMs use this template
-                dependent_qubes = qube.qvm_collection.get_vms_based_on(qube.qid)
-                if len(dependent_qubes) > 0:
-                    module.fail_json(msg='Please remove VMs dependent on this template first')
-                if qvm_collection.default_template_qid == qube.qid:
-                    qvm_collection.default_template_qid = None
+def register(module, qvm_collection, options):
+    '''Adds a new qube to the collection without creating its disks'''
+    try:
+        return qvm_collection.add_new_vm(options['type'], **options['args'])
+    except QubesException as e:
+        module.fail_json(msg='Unable to create VM: %s' % e)
 
-            if qube.is_netvm():
-                if qvm_collection.default_netvm_qid == qube.qid:
-                    qvm_collection.default_netvm_qid = None
 
-            if qube.installed_by_rpm:
-                module.fail_json(msg='Qube managed by RPM/DNF')
+def remove(module, qvm_collection, qube, deferred=False):
+    '''Shuts down and removes the qube. When deferred, its storage is moved
+    into the trash for reclaim() rather than deleted'''
+    if qube.is_running():
+        try:
+            qube.force_shutdown()
+        except (IOError, OSError, QubesException) as e:
+            module.fail_json(msg='Unable to shutdown VM: %s' % e)
 
+    if qube.is_template():
+        if qvm_collection.default_template_qid == qube.qid:
+            qvm_collection.default_template_qid = None
+
+    if qube.is_netvm():
+        if qvm_collection.default_netvm_qid == qube.qid:
+            qvm_collection.default_netvm_qid = None
+
+    with qvm_collection.profiler.phase('remove_from_disk'):
+        if deferred:
+            move_to_trash(qube)
+        else:
             qube.remove_from_disk()
-            qvm_collection.pop(qube.qid)
+    qvm_collection.pop(qube.qid)
+
+
+def trash_path():
+    '''Directory holding the storage of removed qubes until reclaimed'''
+    return os.path.join(system_path['qubes_base_dir'], 'ansible-trash')
+
+
+def move_to_trash(qube):
+    '''Runs the removal hooks of the qube and moves its storage directory
+    into the trash. When it cannot simply be renamed there (for example on
+    another filesystem), the storage is deleted straight away, without
+    running the hooks again'''
+    trash = trash_path()
+    try:
+        if not os.path.isdir(trash):
+            os.makedirs(trash)
+    except OSError:
+        qube.remove_from_disk()
+        return
+    for hook in getattr(qube, 'hooks_remove_from_disk', []):
+        hook(qube)
+    try:
+        os.rename(qube.dir_path, os.path.join(trash, '%s.%d.%d' % (qube.name, qube.qid, time.time() * 1000)))
+    except OSError:
+        qube.storage.remove_from_disk()
+
+
+def pending_reclaim():
+    '''Lists the directories in the trash with the bytes they still use'''
+    trash = trash_path()
+    if not os.path.isdir(trash):
+        return []
+
+    pending = []
+    for entry in sorted(os.listdir(trash)):
+        if entry.startswith('.'):
+            continue
+        size = 0
+        for root, dirs, files in os.walk(os.path.join(trash, entry)):
+            for name in files:
+                try:
+                    size += os.lstat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+        pending.append(dict(name=entry, bytes=size))
+    return pending
+
+
+def reclaim_file(path, rate):
+    '''Deletes a file, first shrinking it by at most rate MB per second'''
+    if rate > 0 and not os.path.islink(path):
+        with open(path, 'r+b') as image:
+            size = os.fstat(image.fileno()).st_size
+            while size > 0:
+                size = max(0, size - rate * 1024 * 1024)
+                os.ftruncate(image.fileno(), size)
+                time.sleep(1)
+    os.unlink(path)
+
+
+def reclaim(rate, blocking=True):
+    '''Deletes everything in the trash. Only one process reclaims at a time;
+    unless blocking, this returns straight away if another one already is'''
+    trash = trash_path()
+    if not os.path.isdir(trash):
+        return
+
+    with open(os.path.join(trash, '.lock'), 'w') as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return
+        for entry in pending_reclaim():
+            for root, dirs, files in os.walk(os.path.join(trash, entry['name']), topdown=False):
+                for name in files:
+                    reclaim_file(os.path.join(root, name), rate)
+                for name in dirs:
+                    path = os.path.join(root, name)
+                    if os.path.islink(path):
+                        os.unlink(path)
+                    else:
+                        os.rmdir(path)
+            os.rmdir(os.path.join(trash, entry['name']))
+
+
+def reclaim_in_background(rate):
+    '''Runs reclaim() from a detached process at idle CPU and I/O priority'''
+    pid = os.fork()
+    if pid:
+        # The intermediate child exits straight away
+        os.waitpid(pid, 0)
+        return
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        # Nothing inherited may be held open while reclaiming, such as the
+        # connection of a daemon's client, which would wait for it to close
+        try:
+            max_fd = os.sysconf('SC_OPEN_MAX')
+        except (AttributeError, ValueError):
+            max_fd = 1024
+        os.closerange(3, max_fd)
+        os.nice(19)
+        try:
+            subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+        except OSError:
+            pass # Reclaimed at normal I/O priority without ionice
+        reclaim(rate, blocking=False)
+    finally:
+        os._exit(0)
+
+
+def shutdown(waves, timeout):
+    '''Cleanly shuts down the running qubes of each wave in turn, waiting for
+    all of them together within a timeout shared by every wave. Qubes still
+    running when it runs out are killed, but not those refusing to shut down,
+    such as netvms with running clients. Returns the seconds each qube took
+    to shut down and whether it had to be killed, and why the others
+    refused, by name'''
+    deadline = time.time() + timeout
+    stopped = {}
+    refused = {}
+    for qubes in waves:
+        started = time.time()
+        running = [qube for qube in qubes if qube.is_running()]
+        for qube in list(running):
+            try:
+                qube.shutdown()
+            except (IOError, OSError, QubesException) as e:
+                refused[qube.name] = str(e)
+                running.remove(qube)
+
+        while running and time.time() < deadline:
+            time.sleep(0.5)
+            for qube in [qube for qube in running if not qube.is_running()]:
+                stopped[qube.name] = dict(seconds=round(time.time() - started, 2), forced=False)
+                running.remove(qube)
+
+        for qube in running:
+            try:
+                qube.force_shutdown()
+            except (IOError, OSError, QubesException):
+                pass # Reported when the qube is removed
+            stopped[qube.name] = dict(seconds=round(time.time() - started, 2), forced=True)
+    return stopped, refused
+
+
+def rebase(module, planned, step):
+    '''Verifies that a step planned against an earlier revision of
+    qubes.xml still holds on the current one. Anything the step would now
+    do beyond what was planned, such as overwriting an attribute that
+    someone else changed in the meantime, is a conflict'''
+    name = step['options']['args']['name']
+    if step['action'] is None:
+        return
+    if step['action'] != planned['action']:
+        module.fail_json(msg='Conflicting change to qube %s: planned %s, now %s'
+                             % (name, planned['action'], step['action']))
+    for key, (current, desired) in step['changes'].items():
+        expected = planned['changes'].get(key, (desired, desired))[0]
+        if describe(current) != describe(expected):
+            module.fail_json(msg='Conflicting change to %s of qube %s: %s when planned, now %s'
+                                 % (key, name, describe(expected), describe(current)))
+
+
+def stop_waves(qvm_collection, qubes):
+    '''Orders qubes to be shut down into waves, each netvm after its clients'''
+    waves = []
+    remaining = list(qubes)
+    while remaining:
+        names = set(qube.name for qube in remaining)
+        wave = [qube for qube in remaining
+                if not any(client.name in names for client in qvm_collection.get_direct_clients(qube.qid)
+                           if client is not qube)]
+        waves.append(wave or remaining)
+        remaining = [qube for qube in remaining if qube not in waves[-1]]
+    return waves
+
+
+def start_qubes(qubes, reserve):
+    '''Starts qubes in parallel, along with the netvms they need. A qube is
+    started once its netvm and template (if also being started) are
+    running, and while the memory of all qubes booting fits in the free
+    memory of the host less reserve MB. Otherwise it is queued, unless
+    nothing else is booting. Returns the seconds each qube took to boot and
+    why each could not, by name'''
+    waiting = []
+    names = set()
+
+    def add(qube):
+        if qube is None or qube.name in names or qube.is_running():
+            return
+        add(qube.netvm)
+        names.add(qube.name)
+        waiting.append(qube)
+    for qube in qubes:
+        add(qube)
+
+    finished = queue.Queue()
+
+    def boot(qube):
+        started = time.time()
+        try:
+            qube.start()
+        except Exception as e:
+            finished.put((qube, None, e))
+        else:
+            finished.put((qube, round(time.time() - started, 2), None))
+
+    booting = {}
+    booted = {}
+    failures = {}
+    while waiting or booting:
+        available = QubesHost().get_free_xen_memory() // 1024 - reserve
+        available -= sum(qube.memory for qube in booting.values())
+        for qube in list(waiting):
+            required = [used.name for used in (qube.netvm, qube.template) if used is not None and used.name in names]
+            failed = [name for name in required if name in failures]
+            if failed:
+                failures[qube.name] = 'Depends on failed qube %s' % ', '.join(failed)
+                waiting.remove(qube)
+            elif all(name in booted for name in required):
+                if booting and qube.memory > available:
+                    break
+                available -= qube.memory
+                waiting.remove(qube)
+                booting[qube.name] = qube
+                threading.Thread(target=boot, args=(qube,)).start()
+
+        if not booting:
+            for qube in waiting:
+                failures[qube.name] = 'Dependency cycle between: %s' % ', '.join(sorted(qube.name for qube in waiting))
+            break
+        qube, seconds, error = finished.get()
+        del booting[qube.name]
+        if error is None:
+            booted[qube.name] = seconds
+        else:
+            failures[qube.name] = 'Unable to start VM: %s' % error
+    return booted, failures
+
+
+def power(module, qvm_collection, targets):
+    '''Starts the qubes to be running and shuts down the qubes to be
+    stopped, reporting the seconds each took as boot or shutdown'''
+    starting = []
+    stopping = []
+    for result, target in targets:
+        if result['failed'] or target.params['state'] not in ('running', 'stopped'):
+            continue
+        qube = qvm_collection.get_vm_by_name(target.params['name'])
+        # Qubes only created in memory by check mode cannot be queried
+        if target.params['state'] == 'running' and (result.get('action') == 'create' or not qube.is_running()):
+            starting.append((result, qube))
+        elif target.params['state'] == 'stopped' and result.get('action') != 'create' and qube.is_running():
+            stopping.append((result, qube))
+
+    if module.check_mode:
+        for result, qube in starting:
+            result.update(changed=True, power='start')
+        for result, qube in stopping:
+            result.update(changed=True, power='stop')
+        return
+
+    with qvm_collection.profiler.phase('shutdown'):
+        stopped, refused = shutdown(stop_waves(qvm_collection, [qube for result, qube in stopping]),
+                                    module.params['shutdown_timeout'])
+    for result, qube in stopping:
+        if qube.name in refused:
+            result.update(failed=True, msg='Unable to shutdown VM: %s' % refused[qube.name])
+        elif qube.name in stopped:
+            result.update(changed=True, shutdown=stopped[qube.name])
+
+    with qvm_collection.profiler.phase('start'):
+        booted, failures = start_qubes([qube for result, qube in starting], module.params['memory_reserve'])
+    for result, qube in starting:
+        if qube.name in failures:
+            result.update(failed=True, msg=failures[qube.name])
+        else:
+            result.update(changed=True, boot=dict(seconds=booted[qube.name]))
+
+
+def converge(module, qvm_collection, created, deferred=False, planned=None):
+    '''Brings the qube described by module.params to its desired state,
+    returning the step taken. New qubes are only registered, and
+    appended to created for provision(). When the step was planned against
+    an earlier revision of qubes.xml, it is rebased onto the current one'''
+    step = plan(module, qvm_collection)
+    options = step['options']
+    if planned is not None:
+        rebase(module, planned, step)
+
+    if step['action'] == 'create':
+        qube = register(module, qvm_collection, options)
+        created.append((qube, options['base_template']))
+    elif step['action'] == 'update':
+        qube = qvm_collection.get_vm_by_name(options['args']['name'])
+        for key, (current, desired) in step['changes'].items():
+            qvm_collection.set_attribute(qube, key, desired)
+    elif step['action'] == 'remove':
+        remove(module, qvm_collection, qvm_collection.get_vm_by_name(options['args']['name']), deferred)
+
+    return step
+
+
+def references(params):
+    '''Names of the qubes that the desired state of a qube refers to'''
+    return set(params[key] for key in ('template', 'netvm', 'dispvm_netvm')
+               if params[key] not in (None, 'none', 'default'))
+
+
+def schedule(targets, qvm_collection):
+    '''Orders the targets into waves that only depend on earlier waves.
+    Qubes to be present come after the templates and netvms they refer to,
+    and qubes to be absent come last, after the qubes that still use them.
+    Targets referring to missing qubes or caught in a dependency cycle are
+    marked as failed up front, along with everything depending on them'''
+    targets = [(result, target) for result, target in targets if not result['failed']]
+    present = set(target.params['name'] for result, target in targets if target.params['state'] != 'absent')
+    absent = set(target.params['name'] for result, target in targets if target.params['state'] == 'absent')
+
+    # Qubes to be removed wait for the removal of the qubes using them
+    users = {}
+    for qube in qvm_collection.values():
+        for key in ('template', 'netvm', 'dispvm_netvm'):
+            used = getattr(qube, key, None)
+            if used is not None and used.name in absent and qube.name in absent:
+                users.setdefault(used.name, set()).add(qube.name)
+
+    requires = {}
+    for result, target in targets:
+        name = target.params['name']
+        if name in absent:
+            requires[name] = users.get(name, set())
+            continue
+        requires[name] = set()
+        for reference in references(target.params):
+            if reference in absent:
+                result.update(failed=True, msg='%s refers to %s, which is to be removed' % (name, reference))
+            elif reference in present:
+                requires[name].add(reference)
+            elif qvm_collection.get_vm_by_name(reference) is None:
+                result.update(failed=True, msg='%s refers to missing qube %s' % (name, reference))
+
+    waves = []
+    scheduled = set()
+    failed = set(target.params['name'] for result, target in targets if result['failed'])
+    remaining = [(result, target) for result, target in targets if not result['failed']]
+    while remaining:
+        ready = scheduled | failed
+        wave = [(result, target) for result, target in remaining
+                if requires[target.params['name']] <= ready
+                and (target.params['name'] in present or present <= ready)]
+        if not wave:
+            cycle = ', '.join(sorted(target.params['name'] for result, target in remaining))
+            for result, target in remaining:
+                result.update(failed=True, msg='Dependency cycle between: %s' % cycle)
+            break
+
+        for result, target in wave:
+            missing = sorted(requires[target.params['name']] & failed)
+            if missing and target.params['name'] in present:
+                result.update(failed=True, msg='Depends on failed qube %s' % ', '.join(missing))
+                failed.add(target.params['name'])
+        wave = [(result, target) for result, target in wave if not result['failed']]
+        waves.append(wave)
+        scheduled.update(target.params['name'] for result, target in wave)
+        remaining = [(result, target) for result, target in remaining
+                     if target.params['name'] not in scheduled | failed]
+    return [wave for wave in waves if wave]
+
+
+def fleet(targets, qvm_collection):
+    '''Describes every qube as it is to be once the targets are converged,
+    by name. Settings a new qube leaves to its defaults are None'''
+    qubes = {}
+    for qube in qvm_collection.values():
+        qubes[qube.name] = dict(memory=getattr(qube, 'memory', None),
+                                maxmem=getattr(qube, 'maxmem', None),
+                                vcpus=getattr(qube, 'vcpus', None),
+                                autostart=getattr(qube, 'autostart', False),
+                                mac=getattr(qube, stored_attributes['mac'], None))
+        for key in ('template', 'netvm', 'dispvm_netvm'):
+            used = getattr(qube, key, None)
+            qubes[qube.name][key] = used.name if used is not None else None
+
+    for result, target in targets:
+        if target is None:
+            continue
+        params = target.params
+        if params['state'] == 'absent':
+            qubes.pop(params['name'], None)
+            continue
+        qube = qubes.setdefault(params['name'], dict(autostart=False))
+        for key in ('memory', 'maxmem', 'vcpus', 'autostart', 'mac', 'template', 'netvm', 'dispvm_netvm'):
+            if params[key] is None:
+                continue
+            # Inherited references are resolved when converging
+            if params[key] in ('none', 'auto', 'default'):
+                qube[key] = None
+            else:
+                qube[key] = params[key]
+    return qubes
+
+
+def autostart_totals(qubes):
+    '''Adds up the memory, maxmem and vcpus of the autostart qubes'''
+    autostart = [qube for qube in qubes.values() if qube.get('autostart')]
+    return [sum(qube.get(key) or 0 for qube in autostart) for key in ('memory', 'maxmem', 'vcpus')]
+
+
+def validate_fleet(module, targets, qvm_collection):
+    '''Checks all the qubes together as they are to be once the targets are
+    converged, returning every problem found: qubes listed more than once,
+    MAC addresses used more than once, references to missing qubes, and
+    autostart qubes overcommitting the memory or cpus of the host. Problems
+    only concerning qubes outside the list are left alone, as are capacity
+    problems the list does not add to'''
+    problems = []
+    listed = {}
+    for result, target in targets:
+        if target is not None:
+            listed[target.params['name']] = listed.get(target.params['name'], 0) + 1
+    for name, count in sorted(listed.items()):
+        if count > 1:
+            problems.append('%s is listed %d times' % (name, count))
+
+    qubes = fleet(targets, qvm_collection)
+    macs = {}
+    for name, qube in sorted(qubes.items()):
+        if qube.get('mac') is not None:
+            macs.setdefault(qube['mac'].upper(), []).append(name)
+        for key in ('template', 'netvm', 'dispvm_netvm'):
+            if qube.get(key) is not None and qube[key] not in qubes and (name in listed or qube[key] in listed):
+                problems.append('%s refers to missing qube %s' % (name, qube[key]))
+    for mac, names in sorted(macs.items()):
+        if len(names) > 1 and set(names) & set(listed):
+            problems.append('MAC address %s is used by %s' % (mac, ', '.join(names)))
+
+    memory_total = host_facts()['memory_total'] // 1024
+    no_cpus = host_facts()['no_cpus']
+    current = autostart_totals(fleet([], qvm_collection))
+    memory, maxmem, vcpus = autostart_totals(qubes)
+    if memory > memory_total and memory > current[0]:
+        problems.append('Autostart qubes need %d MB of memory, but this host has only %d MB' % (memory, memory_total))
+    if module.params['maxmem_overcommit'] and maxmem > memory_total * module.params['maxmem_overcommit'] \
+            and maxmem > current[1]:
+        problems.append('Autostart qubes may grow to %d MB of memory, over %s times the %d MB of this host'
+                        % (maxmem, module.params['maxmem_overcommit'], memory_total))
+    if module.params['vcpu_overcommit'] and vcpus > no_cpus * module.params['vcpu_overcommit'] \
+            and vcpus > current[2]:
+        problems.append('Autostart qubes have %d vcpus, over %s times the %d cpus of this host'
+                        % (vcpus, module.params['vcpu_overcommit'], no_cpus))
+    return problems
+
+
+def desired_fingerprint(module):
+    '''Hashes the parameters of the run together with the current boot'''
+    return hashlib.sha1(json.dumps([module.params, boot_id()], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_fingerprints(path):
+    '''Reads the revision of qubes.xml each recorded run succeeded against'''
+    try:
+        with open(path) as fingerprints_file:
+            return json.load(fingerprints_file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def record_fingerprint(path, fingerprint, revision):
+    '''Records that a run succeeded against a revision of qubes.xml. Runs
+    recorded against any other revision are dropped, as they no longer match'''
+    fingerprints = dict((key, value) for key, value in load_fingerprints(path).items()
+                        if value == list(revision))
+    fingerprints[fingerprint] = list(revision)
+    try:
+        write_json(path, fingerprints)
+    except (IOError, OSError):
+        pass
+
+
+def batch_targets(module):
+    '''Pairs a result with a module-like object for every qube to converge.
+    Entries of the qubes list that cannot be parsed are paired with None'''
+    if module.params['qubes'] is None:
+        return [(dict(name=module.params['name'], changed=False, failed=False), module)]
+
+    targets = []
+    for item in module.params['qubes']:
+        result = dict(name=item.get('name') if isinstance(item, dict) else None,
+                      changed=False, failed=False)
+        try:
+            targets.append((result, QubeItem(item_params(item))))
+        except QubeFailure as e:
+            result.update(failed=True, msg=str(e))
+            targets.append((result, None))
+    return targets
+
+
+def daemon_request(module):
+    '''Hands the run over to a running qubes_daemon.py, returning its result,
+    or None when no daemon accepts it within daemon_timeout. The run fails
+    when its result does not arrive in time'''
+    request = json.dumps(dict(params=module.params, check_mode=module.check_mode, diff=module._diff))
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(module.params['daemon_timeout'])
+    try:
+        client.connect(module.params['daemon_socket'])
+        client.sendall(request.encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+    except socket.error:
+        client.close()
+        return None
+
+    try:
+        response = []
+        while True:
+            data = client.recv(65536)
+            if not data:
+                break
+            response.append(data)
+    except socket.timeout:
+        module.fail_json(msg='No result from the qubes daemon on %s after %s seconds'
+                         % (module.params['daemon_socket'], module.params['daemon_timeout']))
+    finally:
+        client.close()
+    if not response:
+        module.fail_json(msg='The qubes daemon on %s returned no result' % module.params['daemon_socket'])
+    return json.loads(b''.join(response).decode('utf-8'))
+
+
+def take_lock(module, qvm_collection, writing=False):
+    '''Locks qubes.xml for reading or writing, failing the run on timeout'''
+    try:
+        if writing:
+            qvm_collection.lock_db_for_writing()
+        else:
+            qvm_collection.lock_db_for_reading()
+    except QubesException as e:
+        module.fail_json(msg=str(e))
+
+
+def run(module, qvm_collection):
+    '''Converges the qubes described by module.params on qvm_collection,
+    which is only reloaded when qubes.xml changed, and finishes through
+    module.exit_json() or module.fail_json()'''
+    profiler = qvm_collection.profiler = Profiler()
+    if module.params['profile']:
+        instrument(module, profiler, module.params['profile_trace'])
+
+    targets = batch_targets(module)
+    deferred = module.params['reclaim'] == 'deferred'
+    # Check mode only reports what is still pending_reclaim
+    if module.params['reclaim_drain'] and not module.check_mode:
+        with profiler.phase('reclaim_drain'):
+            reclaim(module.params['reclaim_rate'])
+
+    # A run identical to one that already succeeded against the current
+    # qubes.xml has nothing left to do
+    # Whether qubes are running is not recorded in qubes.xml
+    powered = any(target is not None and target.params['state'] in ('running', 'stopped')
+                  for result, target in targets)
+    fingerprint = None
+    if module.params['fingerprint_cache'] and not module.check_mode and not powered:
+        fingerprint = desired_fingerprint(module)
+        revision = list(store_revision(system_path['qubes_store_filename']))
+        if load_fingerprints(module.params['fingerprint_cache']).get(fingerprint) == revision:
+            report(module, [result for result, target in targets])
+
+    # Plan under the read lock, so that runs which change nothing neither
+    # block other tools nor rewrite qubes.xml. Optimistic runs plan without
+    # any lock, as qubes.xml is only ever replaced whole
+    optimistic = module.params['optimistic']
+    qvm_collection.lock_timeout = module.params['lock_timeout']
+    if not optimistic:
+        take_lock(module, qvm_collection)
+    qvm_collection.refresh()
+    planned_revision = qvm_collection.revision
+
+    if module.params['qubes'] is None:
+        waves = [targets]
+    else:
+        with profiler.phase('validate_fleet'):
+            problems = validate_fleet(module, targets, qvm_collection)
+        if problems:
+            if not optimistic:
+                qvm_collection.unlock_db()
+            module.fail_json(msg='Invalid qubes: %s' % '; '.join(problems), changed=False, problems=problems,
+                             results=[result for result, target in targets])
+        waves = schedule(targets, qvm_collection)
+
+    pending = False
+    stopping = []
+    planned = {}
+    diffs = {}
+    for wave in waves:
+        stopping.append([])
+        for result, target in wave:
+            try:
+                with profiler.phase('plan'):
+                    step = plan(target, qvm_collection)
+            except QubeFailure as e:
+                result.update(failed=True, msg=str(e))
+                continue
+            planned[id(target)] = step
+            if module.check_mode and module._diff:
+                diffs[result['name']] = step_diff(step)
+            if module.check_mode:
+                result.update(changed=step['action'] is not None, action=step['action'],
+                              changes=describe_changes(step),
+                              disk=disk_operations(qvm_collection, step))
+            # Later waves may refer to qubes created or removed by earlier
+            # ones, so those are mirrored in memory (and never saved)
+            if step['action'] == 'create':
+                register(target, qvm_collection, step['options'])
+            elif step['action'] == 'remove':
+                qube = qvm_collection.get_vm_by_name(step['options']['args']['name'])
+                stopping[-1].append(qube)
+                qvm_collection.pop(qube.qid)
+            pending = pending or step['action'] is not None
+    if not optimistic:
+        qvm_collection.unlock_db()
+
+    if module.check_mode:
+        pending = False
+        stopping = []
+
+    # Qubes to be removed are shut down before taking the write lock. Those
+    # refusing to are killed by remove()
+    with profiler.phase('shutdown'):
+        stopped, refused = shutdown(stopping, module.params['shutdown_timeout'])
+    for result, target in targets:
+        if result['name'] in stopped:
+            result['shutdown'] = stopped[result['name']]
+
+    if pending:
+        take_lock(module, qvm_collection, writing=True)
+        # Optimistic runs rebase their plan when qubes.xml changed since
+        rebased = optimistic and store_revision(system_path['qubes_store_filename']) != planned_revision
+        qvm_collection.refresh()
+
+        # Each wave is converged and has its disks created in parallel
+        # before the next one, which may use its qubes, is started
+        for wave in waves:
+            created = []
+            for result, target in wave:
+                if result['failed']:
+                    continue
+                try:
+                    with profiler.phase('converge'):
+                        step = converge(target, qvm_collection, created, deferred,
+                                        planned.get(id(target)) if rebased else None)
+                    result.update(changed=step['action'] is not None, changes=describe_changes(step))
+                    if module._diff:
+                        diffs[result['name']] = step_diff(step)
+                except QubeFailure as e:
+                    result.update(failed=True, msg=str(e))
+
+            written = {}
+            with profiler.phase('create_on_disk'):
+                failures = provision(qvm_collection, created, module.params['create_concurrency'],
+                                     module.params['clone'], written)
+            for result, target in wave:
+                if result['name'] in written:
+                    result['bytes_written'] = written[result['name']]
+            for qube, error in failures:
+                for result, target in wave:
+                    if result['name'] == qube.name:
+                        result.update(changed=False, failed=True, msg='Unable to create VM on disk: %s' % error)
+
+        if any(result['changed'] for result, target in targets):
+            qvm_collection.save()
+        qvm_collection.unlock_db()
+
+        if deferred and pending_reclaim():
+            reclaim_in_background(module.params['reclaim_rate'])
+
+    if powered:
+        power(module, qvm_collection, targets)
+
+    results = [result for result, target in targets]
+    if fingerprint is not None and not any(result['failed'] for result in results) \
+            and qvm_collection.revision is not None:
+        record_fingerprint(module.params['fingerprint_cache'], fingerprint, qvm_collection.revision)
+    report(module, results, diffs)
+
+
+def report(module, results, diffs=None):
+    '''Finishes the run with the results of its qubes, and the diff of the
+    (before, after) states in diffs of those that changed'''
+    changed = any(result['changed'] for result in results)
+    failed = [result for result in results if result['failed']]
+
+    if module._diff:
+        diffs = diffs or {}
+        diff = [dict(before_header=result['name'], after_header=result['name'],
+                     before=diffs[result['name']][0], after=diffs[result['name']][1])
+                for result in results if result['changed'] and result['name'] in diffs]
+    else:
+        diff = None
+
+    if module.params['qubes'] is None:
+        if failed:
+            module.fail_json(msg=failed[0]['msg'], changed=changed)
+        module.exit_json(changed=changed, diff=diff and diff[0],
+                         qubes_host_facts=host_facts(), pending_reclaim=pending_reclaim(),
+                         **dict((key, value) for key, value in results[0].items()
+                                if key not in ('name', 'changed', 'failed')))
+
+    if failed:
+        module.fail_json(msg='Unable to converge qubes: %s' % ', '.join('%s' % result['name'] for result in failed),
+                         changed=changed, results=results)
+    module.exit_json(changed=changed, results=results, diff=diff, qubes_host_facts=host_facts(),
+                     pending_reclaim=pending_reclaim())
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=argument_spec,
+        required_one_of=[['name', 'qubes']],
+        mutually_exclusive=[['name', 'qubes']],
+        supports_check_mode=True,
+    )
+
+    if module.params['daemon_socket'] and os.path.exists(module.params['daemon_socket']):
+        result = daemon_request(module)
+        if result is not None:
+            if result.pop('failed', False):
+                module.fail_json(**result)
+            module.exit_json(**result)
+
+    if not import_qubes():
+        module.fail_json(msg='This module must be run from QubeOS dom0')
 
-    qvm_collection.save()
-    qvm_collection.unlock_db()
-    module.exit_json(changed=changed)
+    run(module, QubesVmIndex(QubesVmCollection()))
 
 if __name__ == '__main__':
         main()
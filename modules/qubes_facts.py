@@ -0,0 +1,118 @@
+# The Qubes OS Project, http://www.qubes-os.org
+#
+# Copyright (C) 2017  Nicklaus McClendon <nicklaus@kulinacs.com>
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+ANSIBLE_METADATA = {'metadata_version': '1.0',
+                                        'status': ['preview'],
+                                        'supported_by': 'community'}
+
+DOCUMENTATION = '''
+---
+module: qubes_facts
+short_description: Gather the configuration of qubes (Qubes virtual machines)
+description:
+    - Returns the configuration of the qubes on the system as the
+      C(qubes_vms) fact, in the format taken by the qubes module's I(qubes)
+      option. The snapshot is cached until qubes.xml changes, so repeated
+      gathering only costs a stat() of qubes.xml
+version_added: "2.3"
+author: "Nicklaus McClendon (@kulinacs)"
+options:
+  name:
+    description:
+      - List of qube names to return. All qubes are returned by default
+  type:
+    description:
+      - List of qube types to return
+    default: ['appvm', 'netvm', 'proxyvm', 'hvm', 'templatehvm']
+  label:
+    description:
+      - List of labels of the qubes to return
+  cache:
+    description:
+      - File caching the snapshot of qubes.xml, or an empty string to
+        always read qubes.xml
+    default: ~/.cache/ansible-qubes/facts.json
+
+requirements:
+  - "python >= 2.6"
+  - qubes
+'''
+
+from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.qubes_vms import qube_values, store_revision, write_json
+import json
+
+try:
+    from qubes.qubes import QubesVmCollection
+    from qubes.qubes import system_path
+    QUBES_DOM0 = True
+except ImportError:
+    QUBES_DOM0 = False
+
+def load_snapshot():
+    '''Describes every qube from qubes.xml, under the read lock'''
+    qvm_collection = QubesVmCollection()
+    qvm_collection.lock_db_for_reading()
+    qvm_collection.load()
+    revision = list(store_revision(system_path['qubes_store_filename']))
+    qvm_collection.unlock_db()
+    return dict(revision=revision, qubes_vms=[qube_values(qube) for qube in qvm_collection.values()])
+
+
+def snapshot(cache):
+    '''Returns the cached snapshot while qubes.xml is unchanged, and takes
+    and caches a new one otherwise'''
+    if cache:
+        try:
+            with open(cache) as cache_file:
+                cached = json.load(cache_file)
+            if cached.get('revision') == list(store_revision(system_path['qubes_store_filename'])):
+                return cached
+        except (IOError, OSError, ValueError):
+            pass
+
+    current = load_snapshot()
+    if cache:
+        try:
+            write_json(cache, current)
+        except (IOError, OSError):
+            pass
+    return current
+
+
+def main():
+    module = AnsibleModule(
+        argument_spec=dict(
+            name=dict(type='list'),
+            type=dict(default=['appvm', 'netvm', 'proxyvm', 'hvm', 'templatehvm'], type='list'),
+            label=dict(type='list'),
+            cache=dict(default='~/.cache/ansible-qubes/facts.json', type='path'),
+        ),
+        supports_check_mode=True,
+    )
+
+    if not QUBES_DOM0:
+        module.fail_json(msg='This module must be run from QubeOS dom0')
+
+    qubes_vms = [qube for qube in snapshot(module.params['cache'])['qubes_vms']
+                 if (module.params['name'] is None or qube['name'] in module.params['name'])
+                 and (module.params['type'] is None or qube['type'] in module.params['type'])
+                 and (module.params['label'] is None or qube['label'] in module.params['label'])]
+    module.exit_json(changed=False, ansible_facts=dict(qubes_vms=qubes_vms))
+
+if __name__ == '__main__':
+        main()
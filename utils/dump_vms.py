@@ -1,70 +1,175 @@
+'''Dumps the configuration of the qubes on the system as YAML for Ansible.
+
+With --state, a fingerprint of every qube is kept between runs, and only
+the qubes added or changed since the previous run are written, followed by
+an entry with state absent for every qube removed since. --merge applies
+those changes to an existing YAML file, such as host_vars, in place.
+--minimal leaves out everything a qube inherits or has by default.
+
+The qubes are described by module_utils/qubes_vms.py, like the qubes_facts
+module does, which is loaded from --module-utils.
+'''
+import argparse
+import hashlib
+import json
+import os
+import sys
+
 import yaml
 from qubes.qubes import QubesVmCollection
-from qubes.qubes import QubesVmLabels
-from qubes.qubes import QubesVmClasses
-
-# Load VM Information
-qvm_collection = QubesVmCollection()
-qvm_collection.lock_db_for_writing()
-qvm_collection.load()
-qvm_collection.unlock_db()
-
-qubes_vms = {}
-
-vm_list = []
-
-ansible_values = ['name',
-                  'standalone',
-                  'pool_name',
-                  'memory',
-                  'maxmem',
-                  'mac',
-                  'pci_strictreset',
-                  'pci_e820_host',
-                  'kernel',
-                  'vcpus',
-                  'kernelopts',
-                  'drive',
-                  'debug',
-                  'default_user',
-                  'include_in_backups',
-                  'qrexec_installed',
-                  'internal',
-                  'guiagent_installed',
-                  'seamless_gui_mode',
-                  'autostart',
-                  'qrexec_timeout',
-                  'timezone']
-
-
-for qube in qvm_collection.values():
-    if qube.type.lower not in ('adminvm', 'templatevm'):
-        current_qube = {}
-        current_qube['state'] = 'present'
-        current_qube['type'] = qube.type.lower()
-        if qube.template is not None:
-            current_qube['template'] = qube.template.name
-        else:
-            current_qube['template'] = 'none'
-        current_qube['label'] = qube.label.name
-        if qube.netvm is not None:
-            current_qube['netvm'] = qube.netvm.name
-        else:
-            current_qube['netvm'] = 'none'
-        if qube.dispvm_netvm is not None:
-            current_qube['dispvm_netvm'] = qube.dispvm_netvm.name
-        else:
-            current_qube['dispvm_netvm'] = 'none'
-        for value in ansible_values:
-            try:
-                current_qube[value] = getattr(qube, value)
-            except:
-                pass
-        if not qube.is_template() and qube.template is None:
-            current_qube['standalone'] = True
+
+# Defaults of the qubes module, which apply to settings left out of its input
+module_defaults = {'state': 'present',
+                   'type': 'appvm',
+                   'standalone': False,
+                   'pool_name': 'default',
+                   'pci_e820_host': False}
+
+
+def load_module(name, path):
+    '''Imports a module from its source file'''
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def minimal_values(qvm_collection, qube, current_qube):
+    '''Reduces the description of a qube to the settings it does not inherit.
+    Inherited kernel, kernelopts, netvm and dispvm_netvm become default, an
+    automatic MAC address becomes auto, and settings equal to the default of
+    the qubes module (or else of the qube's class) are left out, so that
+    applying the result leaves the qube unchanged'''
+    # The qubes module resolves a default kernel and netvm when applying
+    # them, so those are only written as default while they still match
+    inherited = dict(kernel=qube.kernel == qvm_collection.get_default_kernel(),
+                     netvm=qube.netvm is qvm_collection.get_default_netvm(),
+                     kernelopts=True,
+                     dispvm_netvm=True)
+    for key in inherited:
+        if inherited[key] and getattr(qube, 'uses_default_' + key, False):
+            current_qube[key] = 'default'
+    if getattr(qube, '_mac', None) is None:
+        current_qube['mac'] = 'auto'
+
+    try:
+        class_defaults = dict((key, config['default']) for key, config in qube.get_attrs_config().items()
+                              if 'default' in config and not callable(config['default']))
+    except AttributeError:
+        class_defaults = {}
+    for key in list(current_qube):
+        if key == 'name':
+            continue
+        if key in module_defaults:
+            if current_qube[key] == module_defaults[key]:
+                del current_qube[key]
+        elif key in class_defaults and current_qube[key] == class_defaults[key]:
+            del current_qube[key]
+    return current_qube
+
+
+def fingerprint(current_qube):
+    '''Hashes the description of a qube'''
+    return hashlib.sha1(json.dumps(current_qube, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def load_state(path):
+    '''Reads the fingerprints of the previous run, by qube name'''
+    try:
+        with open(path) as state:
+            return json.load(state)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def dump(qubes_vms_utils, qvm_collection, previous, fingerprints, minimal=False):
+    '''Yields the description of every qube, or only of those whose
+    fingerprint differs from previous when that is given, followed by
+    removal entries for the qubes that are gone. The fingerprint of every
+    qube is recorded in fingerprints'''
+    for qube in qvm_collection.values():
+        if qube.type.lower() not in ('adminvm', 'templatevm'):
+            current_qube = qubes_vms_utils.qube_values(qube)
+            if minimal:
+                current_qube = minimal_values(qvm_collection, qube, current_qube)
+            fingerprints[qube.name] = fingerprint(current_qube)
+            if previous is None or previous.get(qube.name) != fingerprints[qube.name]:
+                yield current_qube
+
+    if previous is not None:
+        for name in sorted(set(previous) - set(fingerprints)):
+            yield dict(name=name, state='absent')
+
+
+def write(stream, qubes_vms):
+    '''Writes the qubes_vms list one qube at a time, as they are described'''
+    empty = True
+    for current_qube in qubes_vms:
+        if empty:
+            stream.write('qubes_vms:\n')
+            empty = False
+        stream.write(yaml.safe_dump([current_qube], default_flow_style=False))
+        stream.flush()
+    if empty:
+        stream.write('qubes_vms: []\n')
+
+
+def merge(path, qubes_vms):
+    '''Applies the changed qubes to the qubes_vms list of a YAML file in place'''
+    with open(path) as merged_file:
+        merged = yaml.safe_load(merged_file) or {}
+    entries = merged.get('qubes_vms') or []
+    positions = dict((entry.get('name'), index) for index, entry in enumerate(entries))
+
+    for current_qube in qubes_vms:
+        if current_qube.get('state') == 'absent':
+            if current_qube['name'] in positions:
+                entries[positions[current_qube['name']]] = None
+        elif current_qube['name'] in positions:
+            entries[positions[current_qube['name']]] = current_qube
         else:
-            current_qube['standalone'] = False
-        vm_list.append(current_qube)
+            entries.append(current_qube)
+
+    merged['qubes_vms'] = [entry for entry in entries if entry is not None]
+    with open(path + '.tmp', 'w') as merged_file:
+        yaml.safe_dump(merged, merged_file, default_flow_style=False)
+    os.rename(path + '.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Dump the configuration of the qubes as YAML for Ansible')
+    parser.add_argument('--state', help='File keeping the fingerprints of the previous run. '
+                                        'Only qubes changed since then are dumped')
+    parser.add_argument('--merge', metavar='FILE', help='Merge the dumped qubes into the qubes_vms list of FILE '
+                                                        'instead of writing them out')
+    parser.add_argument('--minimal', action='store_true',
+                        help='Write default or auto for inherited settings and leave out default values')
+    parser.add_argument('--module-utils', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               '..', 'module_utils', 'qubes_vms.py'),
+                        help='Path of the qubes_vms module_utils')
+    args = parser.parse_args()
+    qubes_vms_utils = load_module('qubes_vms', args.module_utils)
+
+    # Load VM Information
+    qvm_collection = QubesVmCollection()
+    qvm_collection.lock_db_for_reading()
+    qvm_collection.load()
+    qvm_collection.unlock_db()
+
+    previous = load_state(args.state) if args.state else None
+    fingerprints = {}
+    qubes_vms = dump(qubes_vms_utils, qvm_collection, previous, fingerprints, args.minimal)
+    if args.merge:
+        merge(args.merge, qubes_vms)
+    else:
+        write(sys.stdout, qubes_vms)
+    if args.state:
+        qubes_vms_utils.write_json(args.state, fingerprints, sort_keys=True)
 
-qubes_vms['qubes_vms'] = vm_list
-print yaml.dump(qubes_vms, default_flow_style=False)
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+'''Keeps the Qubes VM collection loaded between runs of the qubes module.
+
+The qubes module hands its runs over to this daemon whenever it is
+listening on the module's daemon_socket, instead of importing the Qubes
+libraries and parsing qubes.xml itself. Runs are served one at a time,
+under the same qubes.xml locks as the module takes, and qubes.xml is only
+reloaded when it changed since the daemon last loaded or saved it.
+
+The stand-in backend used by tests and benchmarks can be served by putting
+it ahead of the Qubes libraries on PYTHONPATH.
+'''
+import argparse
+import json
+import os
+import signal
+import socket
+import sys
+
+
+def load_module(name, path):
+    '''Imports a module from its source file'''
+    try:
+        import importlib.util
+    except ImportError:
+        import imp
+        return imp.load_source(name, path)
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_qubes_module(path, module_utils_path):
+    '''Imports the qubes module from its source file, after the qubes_vms
+    module_utils it imports, which Ansible would otherwise bundle with it'''
+    sys.modules['ansible.module_utils.qubes_vms'] = load_module('ansible.module_utils.qubes_vms', module_utils_path)
+    return load_module('ansible_module_qubes', path)
+
+
+class ModuleExit(Exception):
+    '''Carries the result of a run out of exit_json or fail_json'''
+    def __init__(self, result):
+        Exception.__init__(self, result.get('msg'))
+        self.result = result
+
+
+class DaemonModule(object):
+    '''Presents a request to the qubes module's run() as an AnsibleModule'''
+    def __init__(self, request):
+        self.params = request['params']
+        self.check_mode = request.get('check_mode', False)
+        self._diff = request.get('diff', False)
+
+    def exit_json(self, **kwargs):
+        raise ModuleExit(kwargs)
+
+    def fail_json(self, **kwargs):
+        kwargs['failed'] = True
+        raise ModuleExit(kwargs)
+
+
+class Daemon(object):
+    '''Serves runs of the qubes module against one long-lived collection'''
+    def __init__(self, qubes_module, qvm_collection=None):
+        self.qubes_module = qubes_module
+        if qvm_collection is None:
+            qvm_collection = qubes_module.QubesVmIndex(qubes_module.QubesVmCollection())
+        self.qvm_collection = qvm_collection
+
+    def handle(self, request):
+        '''Runs a single request, returning what the module should report'''
+        try:
+            self.qubes_module.run(DaemonModule(request), self.qvm_collection)
+        except ModuleExit as e:
+            return e.result
+        except Exception as e:
+            self.qvm_collection.revision = None
+            return dict(failed=True, msg='qubes daemon: %s' % e)
+        finally:
+            # fail_json() may leave the lock taken, which process exit
+            # releases for the module but not for the daemon
+            if getattr(self.qvm_collection, 'qubes_store_file', None) is not None:
+                self.qvm_collection.unlock_db()
+        return dict(failed=True, msg='qubes daemon: run finished without a result')
+
+    def serve(self, socket_path, timeout=10):
+        '''Accepts requests on a Unix socket until interrupted. Clients not
+        sending their whole request, or not reading the response, within
+        timeout seconds are dropped, so that they cannot hold up the others'''
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(socket_path)
+        os.chmod(socket_path, 0o660)
+        server.listen(16)
+        try:
+            while True:
+                connection, address = server.accept()
+                connection.settimeout(timeout)
+                try:
+                    self.respond(connection)
+                except socket.error:
+                    pass # The client timed out or went away
+                finally:
+                    connection.close()
+        finally:
+            server.close()
+            os.unlink(socket_path)
+
+    def respond(self, connection):
+        data = []
+        while True:
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            data.append(chunk)
+        try:
+            request = json.loads(b''.join(data).decode('utf-8'))
+            request['params']
+        except (ValueError, KeyError, TypeError):
+            response = dict(failed=True, msg='qubes daemon: malformed request')
+        else:
+            response = self.handle(request)
+        connection.sendall(json.dumps(response).encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve runs of the qubes Ansible module from dom0')
+    parser.add_argument('--socket', default='/var/run/qubes/ansible-qubes.sock',
+                        help='Unix socket to listen on (the module\'s daemon_socket)')
+    parser.add_argument('--module', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                         '..', 'modules', 'qubes.py'),
+                        help='Path of the qubes module')
+    parser.add_argument('--module-utils', default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                               '..', 'module_utils', 'qubes_vms.py'),
+                        help='Path of the qubes_vms module_utils')
+    parser.add_argument('--timeout', type=float, default=10,
+                        help='Seconds a client may take to send its request or read the response (default: 10)')
+    args = parser.parse_args()
+
+    qubes_module = load_qubes_module(args.module, args.module_utils)
+    if not qubes_module.import_qubes():
+        sys.exit('This daemon must be run from QubeOS dom0')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        Daemon(qubes_module).serve(args.socket, args.timeout)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()